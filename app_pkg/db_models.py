@@ -1,9 +1,11 @@
 import os, logging, traceback
+from queue import Queue
 from shutil import rmtree
 from app_pkg import db, login
 from flask_login import UserMixin
 from datetime import datetime
-from sqlalchemy import event
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
    
 logger = logging.getLogger('__main__')
 
@@ -14,7 +16,8 @@ task_destination = db.Table('task_destination',
 
 task_instance = db.Table('task_instance',
                             db.Column('task_id', db.String(18), db.ForeignKey('task.id')),
-                            db.Column('sop_instance_uid', db.String(64), db.ForeignKey('instance.SOPInstanceUID')))
+                            db.Column('sop_instance_uid', db.String(64), db.ForeignKey('instance.SOPInstanceUID')),
+                            db.Index('ix_task_instance_task_id_sop_instance_uid', 'task_id', 'sop_instance_uid'))
 
 class Patient(db.Model):
     PatientID = db.Column(db.String(64), primary_key=True)
@@ -111,6 +114,8 @@ class Device(db.Model):
     address = db.Column(db.String(16), index=True, nullable=False)
     port = db.Column(db.Integer(), index=True, nullable=False)
     is_destination = db.Column(db.Boolean, default=False)
+    transfer_syntax = db.Column(db.String(16), default='uncompressed')   # 'uncompressed', 'deflate' or 'rle'
+    priority = db.Column(db.Integer, default=0) # Priority of the tasks received from this device
     
     def __repr__(self):
         return f'<Device {self.name}: {self.ae_title}@{self.address}>'    
@@ -129,7 +134,7 @@ class Source(db.Model):
 class Task(db.Model):
     id = db.Column(db.String(18), primary_key=True)
     started = db.Column(db.DateTime, default=datetime.now)
-    updated = db.Column(db.DateTime)
+    updated = db.Column(db.DateTime, index=True)
     current_step = db.Column(db.String(32))
     recon_settings = db.Column(db.Text()) # JSON
     step_state = db.Column(db.Integer, index=True) # -1 failed, 0 processing, 1 processing, 2 completed
@@ -138,6 +143,7 @@ class Task(db.Model):
     imgs = db.Column(db.Integer)
     expected_imgs = db.Column(db.Integer)
     visible = db.Column(db.Boolean, default=True) # Task should be shown on frontend
+    priority = db.Column(db.Integer, default=0) # Tasks with higher priority are processed first
     
     # One-to-many relationships (as child)
     series = db.Column(db.String(64), db.ForeignKey('series.SeriesInstanceUID')) 
@@ -151,6 +157,12 @@ class Task(db.Model):
     destinations = db.relationship('Device', secondary=task_destination, backref='tasks')  
     instances =  db.relationship('Instance', secondary=task_instance, backref='tasks')
 
+    __table_args__ = (
+        # Open tasks for a series and source (Compilator) and tasks in a given step and state
+        db.Index('ix_task_series_source_step', 'series', 'source', 'current_step', 'step_state'),
+        db.Index('ix_task_current_step_step_state', 'current_step', 'step_state'),
+    )
+
     def __repr__(self):
         return f'<Task {self.id}>'
 
@@ -160,6 +172,27 @@ def update_task_modified_timestamp(mapper, connection, target):
     logger.debug(f"updating task {target.id}")
     target.updated = datetime.now()
     
+# Ids of the tasks whose step_state was set to 1 (step completed), announced once the
+# change is committed so the TaskManager can dispatch them without polling the database
+completed_steps = Queue()
+
+@event.listens_for(Session, 'after_flush')
+def collect_completed_steps(session, flush_context):
+    # Remember the tasks flagged as completed in this transaction
+    for target in list(session.new) + list(session.dirty):
+        if isinstance(target, Task) and target.step_state == 1:
+            if target in session.new or inspect(target).attrs.step_state.history.has_changes():
+                session.info.setdefault('completed_steps', set()).add(target.id)
+
+@event.listens_for(Session, 'after_commit')
+def announce_completed_steps(session):
+    for task_id in session.info.pop('completed_steps', ()):
+        completed_steps.put(task_id)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_completed_steps(session):
+    session.info.pop('completed_steps', None)
+
 @event.listens_for(Task, 'before_delete')
 def delete_task(mapper, connection, target):
     # Delete originating series if it is not related to other tasks
@@ -201,6 +234,14 @@ class AppConfig(db.Model):
     zip_dir = db.Column(db.String(128), default=os.path.join('temp','packed_series'))
     unzip_dir = db.Column(db.String(128), default=os.path.join('temp','unpacked_series'))
     download_path = db.Column(db.String(128), default=os.path.join('temp','series_to_unpack'))
+    # Tasks processed at the same time by each stage
+    validator_workers = db.Column(db.Integer, default=1)
+    packer_workers = db.Column(db.Integer, default=1)
+    uploader_workers = db.Column(db.Integer, default=1)
+    downloader_workers = db.Column(db.Integer, default=1)
+    unpacker_workers = db.Column(db.Integer, default=1)
+    store_scu_workers = db.Column(db.Integer, default=1)
+    payload_format = db.Column(db.String(16), default='float32')   # 'float32' or 'int_zstd'
 
     def __repr__(self):
         return f"<AppConfig for client {self.client_id}>"    
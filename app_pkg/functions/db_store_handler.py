@@ -1,16 +1,20 @@
 import os, logging, traceback
-from queue import Queue
+from io import BytesIO
 from datetime import datetime
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from pynetdicom.events import Event
 from pydicom import Dataset, dcmread
-from app_pkg import application, db
+from app_pkg import db
 from app_pkg.db_models import Patient, Study, Series, Instance
+from app_pkg.functions.metadata_cache import instance_metadata
+from app_pkg.functions.durable_queue import DurableQueue
 from pymysql.err import IntegrityError
 
 logger = logging.getLogger('__main__')
 
 # Some functions to manage database operations
-def db_create_update_patient(ds: Dataset) -> Patient:
+def db_create_update_patient(ds: Dataset, commit: bool = True) -> Patient:
     
     pat_id = str(ds.PatientID)
     patient = Patient.query.get(pat_id)
@@ -23,10 +27,11 @@ def db_create_update_patient(ds: Dataset) -> Patient:
     if 'PatientName' in ds:
         patient.PatientName = str(ds.PatientName)
 
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return patient
 
-def db_create_update_study(ds: Dataset, path:str = None) -> Study:
+def db_create_update_study(ds: Dataset, path:str = None, commit: bool = True) -> Study:
 
     uid = ds.StudyInstanceUID
     study = Study.query.get(uid)
@@ -34,7 +39,7 @@ def db_create_update_study(ds: Dataset, path:str = None) -> Study:
     if not study:
         logger.info('creating new study.')
         # Find corresponding patient or create it if it doesn't exist
-        patient = db_create_update_patient(ds)
+        patient = db_create_update_patient(ds, commit)
         study = Study(StudyInstanceUID = uid, patient = patient, stored_in = path)
         db.session.add(study)
         
@@ -50,11 +55,12 @@ def db_create_update_study(ds: Dataset, path:str = None) -> Study:
     if 'PatientAge' in ds:
         study.PatientAge = str(ds.PatientAge)
 
-    db.session.commit()
+    if commit:
+        db.session.commit()
 
     return study
     
-def db_create_update_series(ds: Dataset, path:str = None) -> Series:
+def db_create_update_series(ds: Dataset, path:str = None, commit: bool = True) -> Series:
 
     uid = ds.SeriesInstanceUID
     series = Series.query.get(uid)
@@ -63,8 +69,8 @@ def db_create_update_series(ds: Dataset, path:str = None) -> Series:
         logger.info('creating new series.')
         # Find corresponding patient and study
         # or create them if they don't exist
-        patient = db_create_update_patient(ds)
-        study = db_create_update_study(ds, os.path.dirname(path))
+        patient = db_create_update_patient(ds, commit)
+        study = db_create_update_study(ds, os.path.dirname(path), commit)
         series = Series(SeriesInstanceUID = uid, patient = patient, study = study, stored_in = path)
         db.session.add(series)
 
@@ -80,7 +86,8 @@ def db_create_update_series(ds: Dataset, path:str = None) -> Series:
                 value = int(value)  
             setattr(series, field, value)
             
-    db.session.commit()
+    if commit:
+        db.session.commit()
         
     return series
 
@@ -111,33 +118,78 @@ def db_create_instance(ds: Dataset, filename: str) -> Instance:
         
     return instance
 
-def extract_from_dataset(ds):
+def db_store_batch(records: List[dict]) -> List[dict]:
+
+    """
+
+        Writes a batch of received instances to the database in a single transaction.
+        Patients, studies and series are created or updated once per batch, and instances
+        that already exist in the database are skipped.
+
+        Args:
+            · records: a list of dicts with the 'dataset' and the 'filename' where it was stored.
+
+        Returns: the records whose instance is available in the database after the write.
+
+    """
 
-    # If ds is an str, read from disk
-    if type(ds) == str:
-        ds = dcmread(ds)
-    # Check if dataset has all mandatory information
-    new_ds = Dataset()
     try:
-        # Append mandatory information to the new dataset
-        new_ds.StudyInstanceUID = ds.StudyInstanceUID
-        new_ds.SeriesInstanceUID = ds.SeriesInstanceUID
-        new_ds.SOPInstanceUID = ds.SOPInstanceUID
-        new_ds.ImagePositionPatient = ds.ImagePositionPatient
-    except AttributeError:
-        raise AttributeError("New dataset could not be processed. Missing DICOM information?")
+        uids = [r['dataset'].SOPInstanceUID for r in records]
+        existing = {uid for uid, in db.session.query(Instance.SOPInstanceUID).
+                                        filter(Instance.SOPInstanceUID.in_(uids))}
+        patients, studies, series = {}, {}, {}
+        for r in records:
+            ds, filename = r['dataset'], r['filename']
+
+            # Create or update parents only once for each batch
+            pat_id = str(ds.PatientID)
+            if pat_id not in patients:
+                patients[pat_id] = db_create_update_patient(ds, commit = False)
+            if ds.StudyInstanceUID not in studies:
+                studies[ds.StudyInstanceUID] = db_create_update_study(ds, os.path.dirname(os.path.dirname(filename)), commit = False)
+            if ds.SeriesInstanceUID not in series:
+                series[ds.SeriesInstanceUID] = db_create_update_series(ds, os.path.dirname(filename), commit = False)
+
+            if ds.SOPInstanceUID in existing:
+                logger.debug('instance already exists. Ignoring')
+                continue
+            existing.add(ds.SOPInstanceUID)
+            db.session.add(Instance(SOPInstanceUID = ds.SOPInstanceUID, 
+                                    SOPClassUID = ds.SOPClassUID,
+                                    filename = filename,
+                                    patient = patients[pat_id],
+                                    study = studies[ds.StudyInstanceUID],
+                                    series = series[ds.SeriesInstanceUID]))
+        db.session.commit()
+        logger.debug(f'{len(records)} instances written to the database')
+        return records
     
-    # Append non mandatory information to new_ds
-    fields = ['NumberOfSlices','PatientName','StudyDate','SeriesDescription']
-    for field in fields:
+    except Exception as e:
+        # Write instances one by one, so a single failing instance doesn't discard the whole batch
+        logger.error(f"batch of {len(records)} instances can't be written to the database. Writing them one by one.")
+        logger.error(traceback.format_exc())
+        db.session.rollback()
+
+    stored = []
+    for r in records:
         try:
-            new_ds[field] = ds[field]
-        except:
-            logger.info(f"{field} not available") 
-    
-    # Send recon information in other dataset
-    recon_ds = Dataset()            
-    fields = ['PixelSpacing', 
+            db_create_instance(r['dataset'], r['filename'])
+            stored.append(r)
+        except (ValueError, IntegrityError) as e:
+            logger.info('instance already exists')
+            db.session.rollback()
+            stored.append(r)
+        except Exception as e:
+            logger.error("Can't write new instance to database")
+            logger.error(traceback.format_exc())
+            db.session.rollback()
+
+    return stored
+
+# Information extracted from each received instance (see extract_from_dataset)
+MANDATORY_FIELDS = ['StudyInstanceUID','SeriesInstanceUID','SOPInstanceUID','ImagePositionPatient']
+OPTIONAL_FIELDS = ['NumberOfSlices','PatientName','StudyDate','SeriesDescription']
+RECON_FIELDS = ['PixelSpacing', 
                 'ReconstructionMethod',
                 'Manufacturer',
                 'ManufacturerModelName',
@@ -152,7 +204,48 @@ def extract_from_dataset(ds):
                 0x000910BB,
                 0x000910DC,
                 0x00671021]
-    for field in fields:
+# Information written to the database for each instance (see db_create_instance)
+DB_FIELDS = ['SOPClassUID', 'PatientID', 'StudyTime', 'StudyDescription', 'PatientSize', 'PatientAge',
+             'SeriesDate', 'SeriesTime', 'Modality', 'SeriesNumber']
+# Private creators of the private RECON_FIELDS, needed to look up their VR when the file is implicit VR
+PRIVATE_CREATORS = [0x00090010, 0x00670010]
+# Tags that must be parsed from each received instance
+HEADER_TAGS = ['SpecificCharacterSet'] + PRIVATE_CREATORS + MANDATORY_FIELDS + OPTIONAL_FIELDS + RECON_FIELDS + DB_FIELDS
+
+def read_header(source) -> Dataset:
+
+    """
+
+        Parses only the HEADER_TAGS from a DICOM file, given its path or a file-like object.
+
+    """
+
+    return dcmread(source, stop_before_pixels = True, specific_tags = HEADER_TAGS)
+
+def extract_from_dataset(ds):
+
+    # If ds is an str, read the required information from disk
+    if type(ds) == str:
+        ds = read_header(ds)
+    # Check if dataset has all mandatory information
+    new_ds = Dataset()
+    try:
+        # Append mandatory information to the new dataset
+        for field in MANDATORY_FIELDS:
+            setattr(new_ds, field, getattr(ds, field))
+    except AttributeError:
+        raise AttributeError("New dataset could not be processed. Missing DICOM information?")
+    
+    # Append non mandatory information to new_ds
+    for field in OPTIONAL_FIELDS:
+        try:
+            new_ds[field] = ds[field]
+        except:
+            logger.info(f"{field} not available") 
+    
+    # Send recon information in other dataset
+    recon_ds = Dataset()            
+    for field in RECON_FIELDS:
         try:
             recon_ds[field] = ds[field]
         except:
@@ -164,6 +257,35 @@ def extract_from_dataset(ds):
     # Return a 'Success' status    
     return new_ds, recon_ds
 
+def write_dataset(ds: Dataset, root_dir: str) -> str:
+
+    """
+
+        Writes a dataset to disk, under root_dir/StudyInstanceUID/SeriesInstanceUID.
+        Returns the file path, or None if the dataset could not be saved.
+
+    """
+
+    # Construct an unique fname for each dataset received
+    filedir = os.path.join(root_dir, 
+                        ds.StudyInstanceUID,
+                        ds.SeriesInstanceUID)
+    filepath = os.path.join(filedir, ds.SOPInstanceUID)
+    # Try to store dataset in disk
+    try:
+        os.makedirs(filedir, exist_ok = True)
+        ds.save_as(filepath, write_like_original = False)
+    except FileNotFoundError as e:        
+        logger.debug("New dataset could not be saved - No such file or directory")
+        logger.debug(repr(e))
+        return None
+    except Exception as e:
+        logger.debug("New dataset could not be saved - unknown error")
+        logger.debug(repr(e))
+        return None
+    
+    return filepath
+
 def store_dataset(ds, root_dir):
 
     # Check if instance already exists    
@@ -178,22 +300,8 @@ def store_dataset(ds, root_dir):
         return 1
     else:
         logger.debug('adding instance to database')
-        # Construct an unique fname for each dataset received
-        filedir = os.path.join(root_dir, 
-                            ds.StudyInstanceUID,
-                            ds.SeriesInstanceUID)
-        # Try to store dataset in disk
-        os.makedirs(filedir, exist_ok = True)
-        filepath = os.path.join(filedir, ds.SOPInstanceUID)
-        try:
-            ds.save_as(filepath, write_like_original = False)
-        except FileNotFoundError as e:        
-            logger.debug("New dataset could not be saved - No such file or directory")
-            logger.debug(repr(e))
-            return -1
-        except Exception as e:
-            logger.debug("New dataset could not be saved - unknown error")
-            logger.debug(repr(e))
+        filepath = write_dataset(ds, root_dir)
+        if not filepath:
             return -1
         # Store in the database
         try:
@@ -209,20 +317,93 @@ def store_dataset(ds, root_dir):
     return 0
 
 
+def db_store_series(datasets: List[Dataset], root_dir: str, commit: bool = True) -> Tuple[Series, int]:
+
+    """
+
+        Stores the datasets of a new series (e.g. the results built by the Unpacker). Files are
+        written to disk in parallel, and the series and all its instances are added to the
+        database in a single transaction.
+
+        Returns the series and the number of instances stored.
+
+    """
+
+    with ThreadPoolExecutor() as executor:
+        filepaths = list(executor.map(lambda ds: write_dataset(ds, root_dir), datasets))
+    written = [(ds, filepath) for ds, filepath in zip(datasets, filepaths) if filepath]
+    if len(written) < len(datasets):
+        logger.error(f"{len(datasets) - len(written)} datasets could not be saved")
+
+    # Create the series (and its patient and study if needed) once, from the first dataset
+    series = db_create_update_series(datasets[0], os.path.join(root_dir, datasets[0].StudyInstanceUID,
+                                                               datasets[0].SeriesInstanceUID), commit = False)
+    db.session.add_all([Instance(SOPInstanceUID = ds.SOPInstanceUID,
+                                 SOPClassUID = ds.SOPClassUID,
+                                 filename = filepath,
+                                 patient = series.patient,
+                                 study = series.study,
+                                 series = series) for ds, filepath in written])
+    if commit:
+        db.session.commit()
+
+    return series, len(written)
+
+def write_encoded_dataset(encoded: bytes, filepath: str) -> bool:
+
+    """
+
+        Writes an encoded dataset (including preamble and file meta information) to filepath.
+        The file is written with a temporary name and renamed when it's complete, so other
+        processes never read a partially written file.
+
+    """
+
+    try:
+        os.makedirs(os.path.dirname(filepath), exist_ok = True)
+        with open(filepath + '.part', 'wb') as f:
+            f.write(encoded)
+        os.replace(filepath + '.part', filepath)
+    except Exception as e:
+        logger.debug("New dataset could not be saved")
+        logger.debug(repr(e))
+        return False
+    
+    return True
+
+# Headers parsed by db_store_handler, kept in memory until the IngestWriter writes their
+# instances to the database (after a restart they are read again from disk): {filename: Dataset}
+received_headers = {}
+
 # Create a handler for the store request event
-def db_store_handler(event: Event, output_queue:Queue, root_dir:str) -> int:
+def db_store_handler(event: Event, output_queue: DurableQueue, root_dir:str) -> int:
+
+    """
+
+        Handles the C-STORE requests received by the StoreSCP. The encoded dataset is written
+        to disk as received from the peer, without decoding and re-encoding it, and only the
+        HEADER_TAGS are parsed. The stored file is put in output_queue, that is kept on disk,
+        where the IngestWriter will write it to the database in batches and then pass it to
+        the Compilator. Success is returned only when both the file and the queue entry are
+        stored, so no instance acknowledged to the peer is lost if the application stops.
+
+    """
             
     # Allow Positron Emission Tomography Image Storage SOPClassUID and ignore the rest
     try:
-        ds = event.dataset
-        ds.file_meta = event.file_meta    
-        assert ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.128'
+        sop_class = event.request.AffectedSOPClassUID
+        assert sop_class == '1.2.840.10008.5.1.4.1.1.128'
     except AssertionError:
-        logger.debug(f"Ignoring new dataset with SOPClassUID {ds.SOPClassUID}")
+        logger.debug(f"Ignoring new dataset with SOPClassUID {sop_class}")
         return 0x0000
     except AttributeError:
-        logger.error(f"SOPClassUID not found for dataset {ds}")
+        logger.error(f"SOPClassUID not found for C-STORE request")
         return 0xC210
+    
+    # Parse the required information only
+    try:
+        encoded = event.encoded_dataset(include_meta = True)
+        ds = read_header(BytesIO(encoded))
     except Exception as exc:
         logger.error(f"Can't decode dataset")
         return 0xC210
@@ -235,22 +416,30 @@ def db_store_handler(event: Event, output_queue:Queue, root_dir:str) -> int:
         logger.debug("New dataset could not be processed. Missing DICOM information?")
         return 0xA700
 
-    with application.app_context():
-        store_result = store_dataset(ds, root_dir)
-    if store_result == -1:
-        logger.debug('an ocurred error when storing dataset.')
-        return 0xA700
-    elif store_result == 1:
+    # Store the dataset in disk if it wasn't received before
+    filepath = os.path.join(root_dir, ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.SOPInstanceUID)
+    if os.path.isfile(filepath):
         logger.debug('instance exists and will not be stored, but put in compilator')
     else:
+        if not write_encoded_dataset(encoded, filepath):
+            logger.debug('an ocurred error when storing dataset.')
+            return 0xA700
         logger.debug('instance stored successfully')
+
+    # Keep the extracted information in memory so the Compilator doesn't have to read it from disk
+    instance_metadata.put(new_ds.SOPInstanceUID, new_ds, recon_ds)
     
     # Put relevant information in processing queue
-    element = {'dataset':new_ds, 'recon_ds':recon_ds,
-               'address': event.assoc.requestor.info['address'],
-               'ae_title': event.assoc.requestor.info['ae_title']}        
-    output_queue.put(element)
+    received_headers[filepath] = ds
+    try:
+        output_queue.put({'filename': filepath,
+                          'address': event.assoc.requestor.info['address'],
+                          'ae_title': event.assoc.requestor.info['ae_title']})
+    except Exception as e:
+        received_headers.pop(filepath, None)
+        logger.error("can't queue the new dataset")
+        logger.error(traceback.format_exc())
+        return 0xA700
 
     # Return a 'Success' status    
     return 0x0000
-    
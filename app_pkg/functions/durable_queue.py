@@ -0,0 +1,119 @@
+import os, json, sqlite3, threading
+from queue import Empty
+from time import monotonic
+
+class DurableQueue():
+
+    """
+
+        Priority queue stored in a SQLite database in WAL mode, with the part of the queue.Queue
+        interface used by the pipeline stages (put, get, get_nowait, empty, qsize, task_done).
+        Items with higher priority are delivered first, and items with the same priority in
+        the order they were put.
+
+        Items are JSON serialized. An item taken with get stays in the database until the
+        thread that took it calls task_done (or release, to put it back in the queue), so the
+        items that were queued or being processed when the application stopped are delivered
+        again when the queue is opened.
+
+        Args:
+            · path: the database file (its directory is created if it doesn't exist).
+
+    """
+
+    def __init__(self, path: str):
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS queue (
+                                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                       item TEXT NOT NULL,
+                                       taken INTEGER NOT NULL DEFAULT 0)""")
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(queue)')]
+        if 'priority' not in columns:
+            self.connection.execute('ALTER TABLE queue ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+        # Items that were being processed when the application stopped are delivered again
+        self.connection.execute('UPDATE queue SET taken = 0')
+
+        self.not_empty = threading.Condition()
+        # Ids of the items taken by each thread and not acknowledged yet
+        self.taken = threading.local()
+
+    def put(self, item, block = True, timeout = None, priority = 0):
+
+        with self.not_empty:
+            self.connection.execute('INSERT INTO queue (item, priority) VALUES (?, ?)', (json.dumps(item), priority))
+            self.not_empty.notify()
+
+    def get(self, block = True, timeout = None):
+
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.not_empty:
+            while (row := self.connection.execute(
+                    'SELECT id, item FROM queue WHERE taken = 0 ORDER BY priority DESC, id LIMIT 1').fetchone()) is None:
+                if not block:
+                    raise Empty
+                if deadline is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            self.connection.execute('UPDATE queue SET taken = 1 WHERE id = ?', (row[0],))
+
+        if not hasattr(self.taken, 'ids'):
+            self.taken.ids = []
+        self.taken.ids.append(row[0])
+        return json.loads(row[1])
+
+    def get_nowait(self):
+
+        return self.get(block = False)
+
+    def task_done(self):
+
+        """ Acknowledges the oldest item taken by this thread, removing it from the database. """
+
+        ids = getattr(self.taken, 'ids', None)
+        if not ids:
+            raise ValueError('task_done() called more times than items taken')
+        with self.not_empty:
+            self.connection.execute('DELETE FROM queue WHERE id = ?', (ids.pop(0),))
+
+    def release(self):
+
+        """ Puts back in the queue the oldest item taken by this thread, keeping its place. """
+
+        ids = getattr(self.taken, 'ids', None)
+        if not ids:
+            raise ValueError('release() called more times than items taken')
+        with self.not_empty:
+            self.connection.execute('UPDATE queue SET taken = 0 WHERE id = ?', (ids.pop(0),))
+            self.not_empty.notify()
+
+    def set_priority(self, item, priority: int):
+
+        """ Changes the priority of an item that is waiting in the queue. """
+
+        with self.not_empty:
+            self.connection.execute('UPDATE queue SET priority = ? WHERE item = ?', (priority, json.dumps(item)))
+
+    def qsize(self) -> int:
+
+        with self.not_empty:
+            return self.connection.execute('SELECT COUNT(*) FROM queue WHERE taken = 0').fetchone()[0]
+
+    def empty(self) -> bool:
+
+        return self.qsize() == 0
+
+    def __contains__(self, item) -> bool:
+
+        """ Checks if an item is queued or being processed. """
+
+        with self.not_empty:
+            return self.connection.execute('SELECT 1 FROM queue WHERE item = ? LIMIT 1',
+                                           (json.dumps(item),)).fetchone() is not None
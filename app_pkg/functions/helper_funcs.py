@@ -1,6 +1,7 @@
 import numpy as np
-import os, logging, subprocess
+import os, logging, subprocess, threading
 from shutil import make_archive, unpack_archive, rmtree
+from scipy import fft
 from scipy.ndimage import gaussian_filter
 from app_pkg import application, db
 from app_pkg.db_models import Task, AppConfig
@@ -8,6 +9,12 @@ from app_pkg.db_models import Task, AppConfig
 # Configure logging
 logger = logging.getLogger('__main__')
 
+# Sigma (in voxels) from which filter_3D filters in the Fourier domain
+FFT_MIN_SIGMA = 8
+
+# Per-thread scratch buffers (see scratch_buffer)
+_scratch = threading.local()
+
 
 def process(task_id):
 
@@ -64,18 +71,24 @@ def ping(target_host, timeout = 100, count = 3):
         return False
     
 
-def filter_3D(img3d, FWHM, pixel_sizes):    
+def filter_3D(img3d, FWHM, pixel_sizes, out = None, fft_sigma = FFT_MIN_SIGMA):    
     """Aplica un filtro Gaussiano 3D a una imagen 3D 
    
     Esta función toma un arreglo de voxels 3D (img3d), y los 
     filtra con un kernel Gaussiano con FWHM (el tamaño del kernel Gaussiano en XYZ en mm)
     
     Devuelve una imagen filtrada.
+
+    El filtrado se hace en float32. Los bordes se tratan como en la versión 1.0.0: el
+    volumen se extiende con un padding linear_ramp de 21 voxels que se descarta al final.
+    Si el sigma es mayor a fft_sigma voxels, el filtro se aplica en el dominio de Fourier.
         
     Args:
         img3d (np.ndarray): arreglo 3D de voxels de la imagen PET 
         FWHM (float): tamaño del kernel Gaussiano en XYZ (mm)        
         pixel_sizes (np.ndarray): arreglo detres elementos con los tamaños de voxel en mm 
+        out (np.ndarray): arreglo float32 donde guardar el resultado (puede ser img3d)
+        fft_sigma (float): sigma mínimo (en voxels) para filtrar con FFT
             
     Salidas:
         img3d (np.ndarray): imagen filtrada con un kernel Gaussiano 
@@ -91,19 +104,109 @@ def filter_3D(img3d, FWHM, pixel_sizes):
    
     Versiones:
     - 1.0.0 (5 de Julio de 2023): Versión inicial de la función.
+    - 1.1.0: float32, buffers reutilizables y filtrado por FFT.
     """
     
     if FWHM == 0:
+        if out is not None and out is not img3d:
+            out[...] = img3d
+            return out
         return img3d
     
-    pad = 21
-    padded  = np.pad(img3d, pad_width=pad, mode='linear_ramp')    
-    
     FWHMss = np.array([FWHM, FWHM, FWHM])
     FWHMs_vox = np.divide(FWHMss, pixel_sizes)
     sigmas = FWHMs_vox/2.35
-    
-    filtered = gaussian_filter(padded, sigmas)               
-    filtered = filtered[pad:-pad,pad:-pad,pad:-pad]            
+
+    # Work in float32 (converting into a reusable buffer if needed)
+    if img3d.dtype == np.float32:
+        volume = img3d
+    else:
+        volume = scratch_buffer('filter_input', img3d.shape, np.float32)
+        volume[...] = img3d
+    if out is None:
+        out = np.empty(img3d.shape, dtype = np.float32)
+
+    pad = 21
+    padded = np.pad(volume, pad_width = pad, mode = 'linear_ramp')
+    crop = (slice(pad, -pad),) * 3
+
+    if sigmas.max() >= fft_sigma:
+        # The FFT wraps around the edges, so the padded volume is extended as gaussian_filter
+        # does (mode='reflect') up to the radius of its kernel
+        radius = [(r, r) for r in (4 * sigmas + 0.5).astype(int)]
+        extended = np.pad(padded, radius, mode = 'symmetric')
+        spectrum = fft.rfftn(extended, workers = -1)
+        for axis, (sigma, (r, _)) in enumerate(zip(sigmas, radius)):
+            shape = [1] * extended.ndim
+            shape[axis] = spectrum.shape[axis]
+            spectrum *= kernel_spectrum(sigma, r, extended.shape[axis], axis == extended.ndim - 1).reshape(shape)
+        filtered = fft.irfftn(spectrum, s = extended.shape, workers = -1)
+        out[...] = filtered[tuple(slice(r + pad, r + pad + n) for (r, _), n in zip(radius, img3d.shape))]
+    else:
+        gaussian_filter(padded, sigmas, output = padded)
+        out[...] = padded[crop]
                 
-    return filtered
\ No newline at end of file
+    return out
+
+def kernel_spectrum(sigma, radius, n, real):
+
+    """
+
+        Returns the spectrum of the 1D Gaussian kernel that gaussian_filter uses (truncated at
+        radius and normalized), centered at 0 in a signal of length n (rfft if real is True).
+
+    """
+
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    signal = np.zeros(n)
+    signal[x] = kernel / kernel.sum()
+    return (fft.rfft(signal) if real else fft.fft(signal)).real
+
+def scratch_buffer(name, shape, dtype):
+
+    """
+
+        Returns an uninitialized array that is reused by the calls of this thread asking for
+        the same name, shape and dtype (only the last array of each name is kept).
+
+    """
+
+    buffers = getattr(_scratch, 'buffers', None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+        buffer = buffers[name] = np.empty(shape, dtype = dtype)
+    return buffer
+
+def rescale_slices(voxels):
+
+    """
+
+        Converts a volume with shape (columns, rows, slices) to uint16 slices with shape
+        (slices, rows, columns), each one normalized to 2**15 - 1 as max value.
+        Returns the slices and the rescale slope of each of them.
+
+    """
+
+    v = np.asarray(voxels).transpose([2,1,0])
+    slopes = v.max(axis = (1,2)) / (2**15 - 1)
+    pixels = (v / slopes.reshape((-1,1,1))).astype(np.uint16)
+    return pixels, slopes
+
+def postfilter(denoised, noise, noise_fraction, FWHM, pixel_sizes):
+
+    """
+
+        Blends the denoised volume with a fraction of the noise, filters it and converts
+        it to uint16 slices (see rescale_slices).
+
+    """
+
+    voxels = scratch_buffer('postfilter', denoised.shape, np.float32)
+    np.multiply(noise, noise_fraction, out = voxels, dtype = np.float32, casting = 'same_kind')
+    np.add(voxels, denoised, out = voxels, dtype = np.float32, casting = 'same_kind')
+    np.abs(voxels, out = voxels)
+    voxels = filter_3D(voxels, FWHM, pixel_sizes, out = voxels)
+    return rescale_slices(voxels)
\ No newline at end of file
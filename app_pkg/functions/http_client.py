@@ -0,0 +1,50 @@
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('__main__')
+
+# (connect, read) timeouts in seconds for each route of the processing server
+TIMEOUTS = {
+    'processing': (5, 30),
+    'check_model': (5, 30),
+    'check_ping': (3, 5),
+}
+DEFAULT_TIMEOUT = (5, 30)
+
+def make_session(retries: int) -> requests.Session:
+
+    """
+
+        Creates a session with a pool of keep-alive connections. Connection errors are retried
+        'retries' times with exponential backoff (read errors only for idempotent methods, so a
+        POST that reached the server is never sent twice).
+
+    """
+
+    retry = Retry(total = retries, connect = retries, read = retries, status = 0,
+                  backoff_factor = 0.5, raise_on_status = False)
+    adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = 10, max_retries = retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Shared by all the services that talk to the server. Pings are not retried,
+# as a failed ping is what tells the monitor that the server is unreachable.
+server_session = make_session(retries = 3)
+ping_session = make_session(retries = 0)
+
+def server_request(method: str, server_url: str, route: str, **kwargs) -> requests.Response:
+
+    """
+
+        Sends a request to a route of the processing server through the shared session,
+        with the timeout defined for that route (unless one is given).
+
+    """
+
+    kwargs.setdefault('timeout', TIMEOUTS.get(route, DEFAULT_TIMEOUT))
+    session = ping_session if route == 'check_ping' else server_session
+    return session.request(method, 'http://' + server_url + '/' + route, **kwargs)
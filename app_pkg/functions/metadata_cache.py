@@ -0,0 +1,48 @@
+import threading, logging
+from typing import Iterable, Tuple, Union
+from pydicom import Dataset
+
+logger = logging.getLogger('__main__')
+
+class InstanceMetadataCache():
+
+    """
+
+        Thread safe cache for the information extracted from each received instance
+        (see extract_from_dataset), keyed by SOPInstanceUID.
+
+        It is filled by the C-STORE handler with the dataset that is already in memory,
+        so the Compilator can check its tasks (slice positions, recon settings) without
+        reading the DICOM files from disk again. Entries are evicted when the task that
+        owns them leaves the Compilator.
+
+    """
+
+    def __init__(self):
+
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def put(self, sop_uid: str, dataset: Dataset, recon_ds: Dataset):
+
+        with self._lock:
+            self._data[sop_uid] = (dataset, recon_ds)
+
+    def get(self, sop_uid: str) -> Union[Tuple[Dataset, Dataset], None]:
+
+        with self._lock:
+            return self._data.get(sop_uid)
+
+    def evict(self, sop_uids: Iterable[str]):
+
+        with self._lock:
+            for uid in sop_uids:
+                self._data.pop(uid, None)
+
+    def __len__(self):
+
+        with self._lock:
+            return len(self._data)
+
+# Shared by the StoreSCP handler and the Compilator
+instance_metadata = InstanceMetadataCache()
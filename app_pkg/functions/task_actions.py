@@ -2,9 +2,14 @@ import logging, threading, os, traceback
 from shutil import rmtree
 from app_pkg import application, db
 from app_pkg.db_models import Task, Patient, Study, Series, Instance
+from app_pkg.functions.durable_queue import DurableQueue
+from app_pkg.services import queues
 
 logger = logging.getLogger('__main__')
 
+# Priority levels added to a task each time it is bumped from the tasks UI
+BUMP_PRIORITY = 10
+
 def delete_task(id):
     try:
         t = Task.query.get(id)
@@ -61,6 +66,27 @@ def retry_last_step(id):
         return f"Error desconocido al reintentar", 500
 
 
+def bump_priority(id):
+
+    try:
+        t = Task.query.get(id)
+        if not t:
+            return f"La tarea {id} no existe", 400    
+        if t.step_state in [-1,2]:
+            return "Solo las tareas en curso pueden priorizarse", 400
+        t.priority = (t.priority or 0) + BUMP_PRIORITY
+        db.session.commit()
+        logger.info(f"task {id} priority raised to {t.priority}")
+        # Move the task forward if it is waiting in a stage queue
+        step_queue = queues.get(t.current_step)
+        if isinstance(step_queue, DurableQueue):
+            step_queue.set_priority(t.id, t.priority)
+        return f"Prioridad de la tarea {id} aumentada a {t.priority}", 200
+    except:
+        logger.error(traceback.format_exc())
+        return f"Error desconocido al priorizar la tarea", 500
+
+
 def delete_finished():    
 
     try:
@@ -0,0 +1,85 @@
+import threading
+from math import floor
+from time import monotonic
+from typing import Hashable, List
+
+class TimerWheel():
+
+    """
+
+        Hashed timer wheel used to schedule one deadline per key.
+
+        Deadlines are stored in slots of 'tick' seconds, so scheduling, rescheduling and
+        cancelling a key are O(1), and checking for expired keys only visits the slots
+        elapsed since the last check instead of every pending deadline.
+        Deadlines further away than a full turn of the wheel stay in their slot until the
+        wheel reaches them again.
+
+        Args:
+            · tick: resolution of the wheel, in seconds.
+            · slots: number of slots in the wheel.
+
+    """
+
+    def __init__(self, tick: float = 1, slots: int = 64):
+
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}
+        self.current = floor(monotonic() / tick)
+        self._lock = threading.Lock()
+
+    def _slot(self, deadline: float) -> set:
+
+        return self.slots[floor(deadline / self.tick) % len(self.slots)]
+
+    def _remove(self, key: Hashable):
+
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self._slot(deadline).discard(key)
+
+    def schedule(self, key: Hashable, delay: float):
+
+        """ Sets (or replaces) the deadline for key, 'delay' seconds from now. """
+
+        with self._lock:
+            self._remove(key)
+            deadline = monotonic() + max(delay, 0)
+            self.deadlines[key] = deadline
+            self._slot(deadline).add(key)
+
+    def cancel(self, key: Hashable):
+
+        with self._lock:
+            self._remove(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+
+        with self._lock:
+            return key in self.deadlines
+
+    def __len__(self) -> int:
+
+        with self._lock:
+            return len(self.deadlines)
+
+    def expired(self) -> List[Hashable]:
+
+        """ Removes and returns the keys whose deadline has passed. """
+
+        now = monotonic()
+        target = floor(now / self.tick)
+        fired = []
+        with self._lock:
+            # Visit the slots elapsed since the last call (at most a full turn)
+            first = max(self.current, target - len(self.slots) + 1)
+            for t in range(first, target + 1):
+                slot = self.slots[t % len(self.slots)]
+                for key in [k for k in slot if self.deadlines[k] <= now]:
+                    slot.discard(key)
+                    del self.deadlines[key]
+                    fired.append(key)
+            self.current = target
+
+        return fired
@@ -4,13 +4,13 @@ import ipaddress, os, logging, traceback
 import pandas as pd
 from datetime import datetime
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import selectinload, contains_eager
 
 
 from app_pkg import application, db
-from app_pkg.db_models import Device, Task, Study, Series, AppConfig, FilterSettings, PetModel, User, Radiopharmaceutical
+from app_pkg.db_models import Device, Task, Patient, Study, Series, AppConfig, FilterSettings, PetModel, User, Radiopharmaceutical
 from app_pkg.services import services
-from app_pkg.functions.task_actions import delete_task, restart_task, retry_last_step, delete_finished, delete_failed
+from app_pkg.functions.task_actions import delete_task, restart_task, retry_last_step, delete_finished, delete_failed, bump_priority
 from app_pkg.functions.helper_funcs import ping
 
 
@@ -63,20 +63,69 @@ def logs():
 ###########################           TASKS          ##############################
 ###################################################################################
 
+# Columns of the tasks table that can be sorted, by their 'data' name in tasks.js
+TASKS_TABLE_ORDER = {
+    'task_id': Task.id,
+    'PatientName': Patient.PatientName,
+    'StudyDate': Study.StudyDate,
+    'status_msg': Task.status_msg,
+    'source': Task.source,
+    'description': Series.SeriesDescription,
+    'imgs': Task.imgs,
+    'started': Task.started,
+    'updated': Task.updated,
+    'priority': Task.priority,
+}
+
 @application.route('/get_tasks_table')
 def get_tasks_table(): 
+
+    """
+        Devuelve una página de la tabla de tareas para DataTables
+        (server-side processing): filtra, ordena y pagina en la base 
+        de datos según los parámetros draw, start, length, order 
+        y search[value].
+        
+    """
+
+    draw = request.args.get('draw', 0, type = int)
     try:
         tasks = (
             Task.query
-            .options(
-                joinedload(Task.destinations),         # Load destinations (Device model)
-                joinedload(Task.task_series)           # Load Series model
-                .joinedload(Series.study)              # Load Study model through Series
-                .joinedload(Study.patient)             # Load Patient model through Study
-            )
-            .all()
+            .outerjoin(Task.task_series)
+            .outerjoin(Series.study)
+            .outerjoin(Series.patient)
         )
-        data = [{'source':t.task_source.identifier,
+        records_total = Task.query.count()
+
+        # Filter
+        search = request.args.get('search[value]', '').strip()
+        if search:
+            pattern = f'%{search}%'
+            tasks = tasks.filter(Task.id.ilike(pattern) | Patient.PatientName.ilike(pattern) |
+                                 Series.SeriesDescription.ilike(pattern) | Task.status_msg.ilike(pattern) |
+                                 Task.source.ilike(pattern))
+        records_filtered = tasks.count() if search else records_total
+
+        # Sort (by the last updated tasks if no valid column is requested)
+        column = request.args.get('columns[{}][data]'.format(request.args.get('order[0][column]', 9)))
+        order = TASKS_TABLE_ORDER.get(column, Task.updated)
+        order = order.asc() if request.args.get('order[0][dir]') == 'asc' else order.desc()
+        tasks = tasks.order_by(order, Task.id.desc())
+
+        # Paginate (length = -1 means all the tasks)
+        tasks = tasks.offset(max(request.args.get('start', 0, type = int), 0))
+        length = request.args.get('length', -1, type = int)
+        if length >= 0:
+            tasks = tasks.limit(length)
+
+        tasks = tasks.options(
+            selectinload(Task.destinations),                        # Load destinations (Device model)
+            contains_eager(Task.task_series).contains_eager(Series.study),    # Series and Study from the joins
+            contains_eager(Task.task_series).contains_eager(Series.patient)   # Patient from the joins
+        ).all()
+
+        data = [{'source':t.source,
                 'destinations': '/'.join([dest.name for dest in t.destinations]),
                 'PatientName': t.task_series.patient.PatientName,
                 'StudyDate': t.task_series.study.StudyDate.strftime('%d/%m/%Y'),
@@ -87,13 +136,15 @@ def get_tasks_table():
                 'status_msg':t.status_msg,
                 'status_full_msg':t.full_status_msg,
                 'updated': t.updated.strftime('%d/%m/%Y %H:%M:%S'),
+                'priority': t.priority or 0,
                 'task_id': t.id} for t in tasks]
     except Exception as e:
         logger.error("can't access database")
         logger.error(traceback.format_exc())
         data = []
+        records_total = records_filtered = 0
 
-    return {"data": data}
+    return {"draw": draw, "recordsTotal": records_total, "recordsFiltered": records_filtered, "data": data}
 
 @application.route('/manage_tasks', methods=['GET', 'POST'])
 def manage_tasks():
@@ -108,6 +159,8 @@ def manage_tasks():
         message, code = retry_last_step(id)   
     elif action == 'restart':
         message, code = restart_task(id)   
+    elif action == 'bump_priority':
+        message, code = bump_priority(id)   
     elif action == 'delete_finished':
         message, code = delete_finished()   
     elif action == 'delete_failed':
@@ -299,7 +352,9 @@ def get_remote_devices():
         devices = [{"name":d.name, 
                     "ae_title":d.ae_title,
                     "address":d.address + ":" + str(d.port),
-                    "is_destination":d.is_destination} 
+                    "is_destination":d.is_destination,
+                    "transfer_syntax":d.transfer_syntax or 'uncompressed',
+                    "priority":d.priority or 0} 
                 for d in Device.query.all()]
         data = {
             "data": devices
@@ -358,6 +413,19 @@ def manage_remote_devices():
     except:
         logger.info('invalid port')
         return {"message":"Error: el puerto no es válido"}    
+
+    # Check transfer syntax
+    transfer_syntax = request.json.get("transfer_syntax", "uncompressed")
+    if transfer_syntax not in ['uncompressed', 'deflate', 'rle']:
+        logger.info('invalid transfer syntax')
+        return {"message":"Error: la compresión no es válida"}    
+
+    # Check priority
+    try:
+        priority = int(request.json.get("priority", 0))
+    except:
+        logger.info('invalid priority')
+        return {"message":"Error: la prioridad no es válida"}    
             
     if action == "add":
         # Add new device        
@@ -366,7 +434,8 @@ def manage_remote_devices():
             return jsonify(message = "Error: el dispositivo ya existe"), 500    
         try:
             # Add device to database
-            new_d = Device(name = device_name, ae_title = ae_title, address = address, port = port, is_destination = request.json['is_destination'])
+            new_d = Device(name = device_name, ae_title = ae_title, address = address, port = port, is_destination = request.json['is_destination'],
+                           transfer_syntax = transfer_syntax, priority = priority)
             db.session.add(new_d)
             db.session.commit()
             logger.info(f'device {new_d} created.') 
@@ -389,6 +458,8 @@ def manage_remote_devices():
             d.address = address
             d.port = port
             d.is_destination = request.json['is_destination']
+            d.transfer_syntax = transfer_syntax
+            d.priority = priority
             db.session.commit()
             logger.info('device edited')
             return {"message":"Dispositivo editado correctamente"}    
@@ -542,6 +613,7 @@ def get_modules_names():
                'db_models',
                'db_store_handler',
                'downloader',
+               'ingest_writer',
                'packer',
                'routes',
                'services',
@@ -7,8 +7,10 @@ from app_pkg.db_models import AppConfig, Task
 
 from app_pkg.functions.loggers import app_logger, dicom_logger
 from app_pkg.functions.db_store_handler import db_store_handler
+from app_pkg.functions.durable_queue import DurableQueue
 
 from app_pkg.services.store_scp import StoreSCP
+from app_pkg.services.ingest_writer import IngestWriter
 from app_pkg.services.compilator import Compilator
 from app_pkg.services.validator import Validator
 from app_pkg.services.task_manager import TaskManager
@@ -28,22 +30,28 @@ app_logger()
 dicom_logger()
 logger = logging.getLogger('__main__')
 
-# Initialize queues for different processes
+# Initialize queues for different processes. The queues of received instances and task ids
+# are stored on disk, so queued and in progress items are resumed when the application restarts
+queues_dir = os.path.join('data', 'queues')
 queues = {
+    'ingest': DurableQueue(os.path.join(queues_dir, 'ingest.db')),
     'compilator': queue.Queue(),
-    'validator': queue.Queue(),
-    'packer': queue.Queue(),
-    'uploader': queue.Queue(),
-    'downloader': queue.Queue(),    
-    'unpacker': queue.Queue(),
-    'store_scu': queue.Queue()
+    'validator': DurableQueue(os.path.join(queues_dir, 'validator.db')),
+    'packer': DurableQueue(os.path.join(queues_dir, 'packer.db')),
+    'uploader': DurableQueue(os.path.join(queues_dir, 'uploader.db')),
+    'downloader': DurableQueue(os.path.join(queues_dir, 'downloader.db')),    
+    'unpacker': DurableQueue(os.path.join(queues_dir, 'unpacker.db')),
+    'store_scu': DurableQueue(os.path.join(queues_dir, 'store_scu.db'))
 }
 
 # Task manager
 task_manager = TaskManager(queues)
 
 # DICOM Store SCP    
-store_scp = StoreSCP(input_queue = queues['compilator'], c_store_handler=db_store_handler)
+store_scp = StoreSCP(input_queue = queues['ingest'], c_store_handler=db_store_handler)
+
+# Ingest Writer
+ingest_writer = IngestWriter(input_queue = queues['ingest'], output_queue = queues['compilator'])
 
 # Compilator       
 compilator = Compilator(input_queue = queues['compilator'], next_step = 'validator')
@@ -71,6 +79,7 @@ monitor =  ServerMonitor('check_ping', 1)
 
 # Initialize services
 services = {'Dicom Listener': store_scp,
+            'Ingest Writer': ingest_writer,
             'Compilator': compilator,
             'Validator': validator,
             'Packer': packer,
@@ -108,9 +117,26 @@ with application.app_context():
 
 if app_config_available:
     if 'db' not in sys.argv and 'shell' not in sys.argv and 'init_db.py' not in sys.argv:
-        # Set all pending tasks state to failed (-1)
+        # Resume the tasks in progress:
+        # · tasks in the Compilator are tracked again by its periodic sweep
+        # · tasks in a stage queue are delivered again by the queue
+        # · tasks waiting for the server (uploaded) keep waiting for it
+        # · tasks that were dispatched but didn't reach their queue are queued again
+        # Other pending tasks are set as failed (-1)
         with application.app_context():
             for task in Task.query.filter_by(step_state = 0).all():
+                step_queue = queues.get(task.current_step)
+                if task.current_step == 'compilator':
+                    continue
+                if isinstance(step_queue, DurableQueue):
+                    if task.id in step_queue:
+                        logger.info(f'resuming task {task.id} in {task.current_step}')
+                    elif task.current_step == 'uploader' and task.status_msg == 'procesando':
+                        logger.info(f'task {task.id} is waiting for the server')
+                    else:
+                        logger.info(f'queueing task {task.id} again in {task.current_step}')
+                        step_queue.put(task.id, priority = task.priority or 0)
+                    continue
                 task.step_state = -1
                 task.status_msg = 'cancelada'
                 task.full_status_msg = """La aplicación se reinició mientras esta tarea estaba
@@ -1,16 +1,22 @@
 import threading, logging, traceback
-from time import sleep
+from queue import Empty
+from time import sleep, monotonic
 from datetime import datetime
 import numpy as np
 from pydicom import Dataset
 
 from app_pkg import application, db
-from app_pkg.db_models import Task, Series, Instance, Source, AppConfig
+from app_pkg.db_models import Task, Series, Instance, Source, AppConfig, Device, task_instance
 from app_pkg.functions.db_store_handler import extract_from_dataset
+from app_pkg.functions.metadata_cache import instance_metadata
+from app_pkg.functions.timer_wheel import TimerWheel
 
 # Configure logging
 logger = logging.getLogger('__main__')
 
+# Tasks lose one priority level for each LARGE_SERIES_IMGS images expected in their series
+LARGE_SERIES_IMGS = 200
+
 class Compilator():
 
     """
@@ -20,15 +26,26 @@ class Compilator():
         The number of instances present in each series is found through a dedicated function.
         For each series received, a Task is created in the database.
         
-        When the process has been sleeping during a predefined time, each task is checked to
-        find if it should be put in the output queue, discarded or keep waiting.
+        Each task is checked to find if it should be put in the output queue, discarded or keep
+        waiting as soon as it receives all its expected instances or its waiting period expires.
     
     """
 
-    def __init__(self, input_queue, next_step = 'validator'):        
+    def __init__(self, input_queue, next_step = 'validator', sweep_period = 5):        
         
         self.input_queue = input_queue   
         self.next_step = next_step   
+        self.sweep_period = sweep_period
+
+        # Deadlines for the tasks waiting for more instances
+        self.timers = TimerWheel()
+
+        # Last task opened for each series and source: {(SeriesInstanceUID, source id): task id}
+        self.open_tasks = {}
+        # SOPInstanceUIDs of the instances of the open tasks: {task id: set of SOPInstanceUIDs}
+        self.task_instances = {}
+        # AppConfig.series_timeout, read again on each sweep (see load_config)
+        self.series_timeout = None
 
     def start(self):
 
@@ -94,27 +111,33 @@ class Compilator():
                 to this Task.
                 - Else, create a new Task and append the instance to it.
             
-            When there are no elements in the input queue, each Task is sent to an independent
-            function that checks it for completeness. Then:
+            Each time an instance is appended to a Task, the Task is checked for completeness
+            if it has received all its expected instances. Otherwise, a deadline is (re)scheduled
+            for it series_timeout seconds later. Tasks are checked by an independent function
+            as soon as they are complete or their deadline expires, even if instances for other
+            series keep arriving. Then:
             · If the series is complete, the output data is written to a file and passed to the
              task_manager, and the Task state is updated in the database.
             · If not, checks if the waiting period for this Task has expired and signals it in
             the database it in that case. Else, waits for more instances.               
 
+            Every sweep_period seconds, the configuration is read again and open tasks that are
+            not being tracked (i.e. tasks restarted from the frontend or interrupted by an app
+            restart) are scheduled again.
+
         """
-        # Inactive timer to know if task status should be checked or not.
-        inactive_time = 0                
+        last_sweep = 0
 
         while not self.stop_event.is_set() or not self.input_queue.empty():
             
+            # Wait for an element in the input queue, at most until the next tick of the timer wheel
+            try:
+                queue_element = self.input_queue.get(timeout = self.timers.tick)
+            except Empty:
+                queue_element = None
 
             with application.app_context():
-                # If there are any elements in the input queue, read them.
-                if not self.input_queue.empty():
-                    # Reset inactivity timer
-                    inactive_time = 0
-                    # Read element from queue
-                    queue_element = self.input_queue.get()
+                if queue_element is not None:
 
                     try:                        
                         dataset = queue_element['dataset']
@@ -132,14 +155,10 @@ class Compilator():
                             db.session.add(source)
                             
                         # Check if this SOP should be appended to an existing or new Task.          
-                        tasks = (Task.query.filter_by(current_step = 'compilator').
-                                filter_by(step_state = 0). 
-                                filter_by(series = series_uid).
-                                join(Source).filter_by(identifier=src_id)).all()
+                        tasks = self.find_open_tasks(series_uid, src_id)
                         matching_task = None
-                        i = Instance.query.get(sop_uid)
                         for task in tasks:
-                            if not i in task.instances:
+                            if not sop_uid in self.task_sops(task.id):
                                 matching_task = task
                                 break
                         
@@ -150,6 +169,7 @@ class Compilator():
                             task_id = timing.strftime('%Y%m%d%H%M%S%f')[:-2]
 
                             # Create new Task in the database
+                            expected_imgs = self.instances_in_series(dataset)
                             task = Task(
                                 id = task_id,
                                 started = timing,
@@ -157,7 +177,8 @@ class Compilator():
                                 current_step = 'compilator',
                                 status_msg = 'recibiendo',
                                 step_state = 0,
-                                expected_imgs = self.instances_in_series(dataset),
+                                expected_imgs = expected_imgs,
+                                priority = self.task_priority(ae_title, ip, expected_imgs),
                                 imgs = 1,
                                 task_series = Series.query.get(series_uid),
                                 instances = [Instance.query.get(sop_uid)],
@@ -166,72 +187,206 @@ class Compilator():
                             db.session.add(task)
                             logger.info(f'created new task {task}')                        
                         else:
-                            # Append to existing series                    
+                            # Append to existing series (inserting the association row directly,
+                            # so the instances of the task are not loaded)
                             logger.debug(f"Appending instance {sop_uid} to task {matching_task}")
-                            matching_task.instances.append(Instance.query.get(sop_uid))
+                            db.session.execute(task_instance.insert().values(task_id = matching_task.id,
+                                                                             sop_instance_uid = sop_uid))
                             matching_task.imgs+=1
+                            task = matching_task
 
                         db.session.commit()
+                        self.open_tasks[(series_uid, src_id)] = task.id
+                        self.task_sops(task.id).add(sop_uid)
                     
                     except Exception as e:
                         logger.error("error processing queue element. Putting it back in the queue.")
                         logger.error(traceback.format_exc())
                         self.input_queue.put(queue_element)
                         sleep(1)
-                        
-                # If there are no elements in the queue and the thread has been inactive for 5 seconds, check
-                # tasks status
-                elif inactive_time >= 5:
-                        
-                    try:
-                        # Reset inactivity timer
-                        inactive_time = 0
-                        for task in Task.query.filter((Task.current_step == 'compilator')&(Task.step_state==0)).all():
-                            
-                            # Check task status
-                            try:
-                                datasets, recon_settings = self.fetch_task_data(task.id)
-                            except Exception as e:
-                                logger.error(f"fetch_task_data failed for task {task.id}")
-                                logger.error(traceback.format_exc())
-                                task.status_msg = 'Fallo - faltan imgs'
-                                task.full_status_msg = """Los archivos DICOM originales de esta tarea no se encontraron.
-                                Por favor eliminala y reiniciala enviando los DICOM originales desde el dispositivo remoto"""
-                                task.step_state = -1    
+
+                    else:
+                        # Check the task right away if all the expected instances were received,
+                        # else wait for more instances until the timeout expires
+                        try:
+                            if task.expected_imgs and task.imgs >= task.expected_imgs:
+                                self.check_task(task.id)
                             else:
-                                status, msg = self.task_status(datasets, 
-                                                        task.expected_imgs, 
-                                                        task.updated)
-                                if status == 'abort':
-                                    logger.info(f"Task {task.id} timed out")
-                                    task.status_msg = 'Fallo - incompleto'
-                                    task.full_status_msg = msg
-                                    task.step_state = -1                        
-                                
-                                elif status == 'wait':
-                                    logger.info(f"Waiting for task {task.id} with {task.imgs} instances to complete.")
-
-                                elif status == 'completed':
-
-                                    # From task_data, keep the required for the next step only
-                                    recon_settings = self.summarize_data(recon_settings, datasets)
-
-                                    # Write task_data to the database and pass the task to the next step
-                                    task.recon_settings = recon_settings.to_json()
-                                    task.current_step = self.next_step
-                                    task.step_state = 1
-                                    task.status_msg = 'validando...'
-                                    logger.info(f"Task {task.id} completed.")
-
-                            db.session.commit()
-                    
+                                self.schedule_task(task)
+                        except:
+                            logger.error(f"error checking task {task.id}.")
+                            logger.error(traceback.format_exc())
+
+                # Check the tasks whose waiting period has expired
+                for task_id in self.timers.expired():
+                    try:
+                        self.check_task(task_id)
+                    except:
+                        logger.error(f"error checking task {task_id}.")
+                        logger.error(traceback.format_exc())
+
+                # Refresh the configuration and recover open tasks that are not being tracked
+                if monotonic() - last_sweep >= self.sweep_period:
+                    last_sweep = monotonic()
+                    try:
+                        self.load_config()
+                        self.track_open_tasks()
                     except:
                         logger.error("error processing current tasks.")
                         logger.error(traceback.format_exc())
 
-                else:
-                    sleep(1)
-                    inactive_time += 1     
+    def find_open_tasks(self, series_uid: str, src_id: str) -> list:
+
+        """
+
+            Returns the open tasks (receiving instances) for a series sent by a source. The
+            task last opened for them is taken from open_tasks while it is still open, so the
+            database is only searched when it is unknown (e.g. after a restart).
+
+        """
+
+        key = (series_uid, src_id)
+        task_id = self.open_tasks.get(key)
+        if task_id is not None:
+            task = Task.query.get(task_id)
+            if task and task.current_step == 'compilator' and task.step_state == 0:
+                return [task]
+            del self.open_tasks[key]
+            self.task_instances.pop(task_id, None)
+
+        tasks = (Task.query.filter_by(series = series_uid, source = src_id,
+                                      current_step = 'compilator', step_state = 0).
+                 order_by(Task.started.desc()).all())
+        if tasks:
+            self.open_tasks[key] = tasks[0].id
+        return tasks
+
+    def task_sops(self, task_id: str) -> set:
+
+        """
+
+            Returns the set of SOPInstanceUIDs of the instances of an open task. It is read
+            from the task_instance table the first time and then kept up to date in memory.
+
+        """
+
+        sops = self.task_instances.get(task_id)
+        if sops is None:
+            sops = self.task_instances[task_id] = set(db.session.scalars(
+                db.select(task_instance.c.sop_instance_uid).where(task_instance.c.task_id == task_id)))
+        return sops
+
+    def close_task(self, task: Task):
+
+        """
+
+            Stops tracking a task that is no longer receiving instances.
+
+        """
+
+        self.timers.cancel(task.id)
+        self.task_instances.pop(task.id, None)
+        if self.open_tasks.get((task.series, task.source)) == task.id:
+            del self.open_tasks[(task.series, task.source)]
+
+    def schedule_task(self, task: Task):
+
+        """
+
+            Schedules a task to be checked when its waiting period (series_timeout seconds
+            since the last instance was received) expires.
+
+        """
+
+        if self.series_timeout is None:
+            self.load_config()
+        elapsed = (datetime.now() - task.updated).total_seconds()
+        self.timers.schedule(task.id, self.series_timeout - elapsed + self.timers.tick)
+
+    def load_config(self):
+
+        """
+
+            Reads the configuration used for each received instance, so the database is not
+            queried for it in the hot path. Changes are picked up on the next sweep.
+
+        """
+
+        self.series_timeout = AppConfig.query.first().series_timeout
+
+    def track_open_tasks(self):
+
+        """
+
+            Checks or schedules the open tasks in the database that are not tracked by the timer wheel.
+
+        """
+
+        for task in Task.query.filter((Task.current_step == 'compilator')&(Task.step_state==0)).all():
+            if task.id in self.timers:
+                continue
+            if task.expected_imgs and task.imgs >= task.expected_imgs:
+                self.check_task(task.id)
+            else:
+                self.schedule_task(task)
+
+    def check_task(self, task_id):
+
+        """
+
+            Checks a task for completeness and updates its state in the database. If more instances
+            should be waited for, the task is scheduled again.
+
+        """
+
+        task = Task.query.get(task_id)
+        if not task or task.current_step != 'compilator' or task.step_state != 0:
+            self.timers.cancel(task_id)
+            self.task_instances.pop(task_id, None)
+            return
+
+        # Check task status
+        try:
+            datasets, recon_settings = self.fetch_task_data(task.id)
+        except Exception as e:
+            logger.error(f"fetch_task_data failed for task {task.id}")
+            logger.error(traceback.format_exc())
+            task.status_msg = 'Fallo - faltan imgs'
+            task.full_status_msg = """Los archivos DICOM originales de esta tarea no se encontraron.
+            Por favor eliminala y reiniciala enviando los DICOM originales desde el dispositivo remoto"""
+            task.step_state = -1    
+            self.close_task(task)
+        else:
+            status, msg = self.task_status(datasets, 
+                                    task.expected_imgs, 
+                                    task.updated)
+            if status == 'abort':
+                logger.info(f"Task {task.id} timed out")
+                task.status_msg = 'Fallo - incompleto'
+                task.full_status_msg = msg
+                task.step_state = -1                        
+                self.close_task(task)
+                instance_metadata.evict([ds.SOPInstanceUID for ds in datasets])
+            
+            elif status == 'wait':
+                logger.info(f"Waiting for task {task.id} with {task.imgs} instances to complete.")
+                self.schedule_task(task)
+
+            elif status == 'completed':
+
+                # From task_data, keep the required for the next step only
+                recon_settings = self.summarize_data(recon_settings, datasets)
+
+                # Write task_data to the database and pass the task to the next step
+                task.recon_settings = recon_settings.to_json()
+                task.current_step = self.next_step
+                task.step_state = 1
+                task.status_msg = 'validando...'
+                logger.info(f"Task {task.id} completed.")
+                self.close_task(task)
+                instance_metadata.evict([ds.SOPInstanceUID for ds in datasets])
+
+        db.session.commit()
 
     def task_status(self, datasets, n_imgs, last_received):
 
@@ -313,6 +468,22 @@ class Compilator():
         return slice_gaps.min() >= lim_inf and slice_gaps.max() <= lim_sup    
 
              
+    def task_priority(self, ae_title: str, address: str, expected_imgs: int) -> int:
+
+        """
+
+            Priority of a new task: the priority of its source device (if it is configured
+            as a remote device), minus one level for each LARGE_SERIES_IMGS images expected
+            in the series, so short series are not delayed behind large ones.
+
+        """
+
+        device = Device.query.filter_by(ae_title = ae_title, address = address).first()
+        priority = (device.priority or 0) if device else 0
+        if expected_imgs:
+            priority -= expected_imgs // LARGE_SERIES_IMGS
+        return priority
+
     def instances_in_series(self, dataset: Dataset) -> int:        
 
         """
@@ -357,6 +528,15 @@ class Compilator():
 
         logger.info(f"fetching datasets for task {task_id}")
         t = Task.query.get(task_id)
-        dss, recon = list(zip(*[extract_from_dataset(inst.filename) for inst in t.instances]))        
+        data = []
+        for inst in t.instances:
+            # Use the information cached at C-STORE time. Read from disk only if it's
+            # not available (i.e. the app was restarted or the task was restarted)
+            cached = instance_metadata.get(inst.SOPInstanceUID)
+            if cached is None:
+                cached = extract_from_dataset(inst.filename)
+                instance_metadata.put(inst.SOPInstanceUID, *cached)
+            data.append(cached)
+        dss, recon = list(zip(*data))
 
         return list(dss), list(recon)
\ No newline at end of file
@@ -1,13 +1,13 @@
 import logging, threading, os, traceback
-from time import sleep
 from shutil import copy
 from app_pkg import application, db
 from app_pkg.db_models import Task, AppConfig
+from app_pkg.services.stage import StageRuntime
 
 # Configure logging
 logger = logging.getLogger('__main__')
 
-class SeriesDownloader():
+class SeriesDownloader(StageRuntime):
 
     def __init__(self, input_queue, next_step = 'unpacker'):
 
@@ -47,10 +47,8 @@ class SeriesDownloader():
             os.makedirs(os.path.join(config.shared_mount_point, 'processed'), exist_ok = True)
 
             if not self.get_status() == 'Corriendo':
-                # Start the thread
-                self.main_thread = threading.Thread(target = self.main, args = ())        
-                self.main_thread.start()
-                logger.info('started')
+                # Start the worker threads
+                self.start_workers(config.downloader_workers, 'Downloader')
                 return "Downloader inició exitosamente"
             else:
                 return "Downloader ya está corriendo"
@@ -75,7 +73,7 @@ class SeriesDownloader():
             # Event to interrupt processing        
             self.stop_event.set()
             # Stop the thread
-            self.main_thread.join()
+            self.join_workers()
             logger.info("Downloader stopped")
             return "Downloader detenido"
         except Exception as e:
@@ -83,35 +81,7 @@ class SeriesDownloader():
             logger.error(traceback.format_exc())
             return "Downloader no pudo ser detenido"
 
-    def get_status(self):
-
-        try:
-            assert self.main_thread.is_alive()            
-        except AttributeError:
-            return 'No iniciado'
-        except AssertionError:
-            return 'Detenido'
-        except:
-            return 'Desconocido'
-        else:
-            return 'Corriendo'
         
-    def main(self):
-
-        while not self.stop_event.is_set() or not self.input_queue.empty():            
-                            
-                if not self.input_queue.empty():
-                    task_id = self.input_queue.get()
-                    with application.app_context():
-                        reprocess = self.task_step_handler(task_id)
-                    while reprocess and not self.stop_event.is_set():
-                        logger.info(f'reprocessing {task_id}')   
-                        with application.app_context():                     
-                            reprocess = self.task_step_handler(task_id)
-                        sleep(5)
-                else:
-                    sleep(1)
-
     def task_step_handler(self, task_id):
                 
         try:
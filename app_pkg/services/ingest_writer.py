@@ -0,0 +1,202 @@
+import threading, logging, traceback
+from queue import Empty
+from time import monotonic
+
+from app_pkg import application
+from app_pkg.functions.db_store_handler import db_store_batch, read_header, extract_from_dataset, received_headers
+from app_pkg.functions.metadata_cache import instance_metadata
+
+# Configure logging
+logger = logging.getLogger('__main__')
+
+class IngestWriter():
+
+    """
+
+        This class writes the instances received by the StoreSCP to the database. Instances are
+        read from input_queue (a DurableQueue with the stored files) and grouped in batches (for
+        up to 'window' seconds or 'max_batch' instances), and each batch is written in a single
+        transaction. When a batch is committed, its instances are put in output_queue to be
+        compiled by the Compilator, and removed from input_queue.
+
+        Instances that can't be written are released back to input_queue and retried, waiting
+        from retry_delay up to max_retry_delay seconds (doubling the delay after each failure).
+        An instance is discarded only if its file can't be read, or if it fails max_attempts
+        times while other instances are written (so it is not discarded while the database is
+        not available).
+
+    """
+
+    def __init__(self, input_queue, output_queue, window = 1, max_batch = 500,
+                 retry_delay = 1, max_retry_delay = 60, max_attempts = 5):
+
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.window = window
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        # Failed attempts of the instances that could not be written: {filename: attempts}
+        self.attempts = {}
+
+    def start(self):
+
+        """
+
+            Starts the process thread.
+
+        """
+
+        if not self.get_status() == 'Corriendo':
+            # Set an event to stop the thread later
+            self.stop_event = threading.Event()
+
+            # Create and start the thread
+            self.main_thread = threading.Thread(target = self.main,
+                                                args = (), name = 'IngestWriter')
+            self.main_thread.start()
+            logger.info('Ingest writer started')
+            return 'Ingest Writer inició exitosamente'
+        else:
+            return 'Ingest Writer ya está corriendo'
+
+    def stop(self):
+
+        """
+
+            Stops the thread by setting an Event.
+
+        """
+        try:
+            self.stop_event.set()
+            self.main_thread.join()
+            logger.info("stopped")
+            return "Ingest Writer detenido"
+        except:
+            logger.info("stopped")
+            return "Ingest Writer no se pudo detener"
+
+    def get_status(self):
+
+        try:
+            assert self.main_thread.is_alive()
+        except AttributeError:
+            return 'No iniciado'
+        except AssertionError:
+            return 'Detenido'
+        except:
+            return 'Desconocido'
+        else:
+            return 'Corriendo'
+
+    def main(self):
+
+        delay = self.retry_delay
+
+        while not self.stop_event.is_set():
+
+            items = self.collect_batch()
+            if not items:
+                continue
+
+            batch = [self.load_record(item) for item in items]
+            records = [record for record in batch if record is not None]
+            with application.app_context():
+                try:
+                    stored = db_store_batch(records) if records else []
+                except:
+                    logger.error(f"error writing a batch of {len(records)} instances")
+                    logger.error(traceback.format_exc())
+                    stored = []
+            stored_files = {record['filename'] for record in stored}
+
+            # Pass the stored instances to the Compilator and acknowledge them, and release the
+            # rest to retry them (items are acknowledged or released in the order they were taken)
+            retry = False
+            for item, record in zip(items, batch):
+                if record is None:
+                    self.input_queue.task_done()
+                elif record['filename'] in stored_files:
+                    self.output_queue.put(record['element'])
+                    self.input_queue.task_done()
+                    self.attempts.pop(record['filename'], None)
+                elif stored and self.failed(record['filename']) >= self.max_attempts:
+                    logger.error(f"{record['filename']} couldn't be written to the database after "
+                                 f"{self.max_attempts} attempts. Discarding it.")
+                    self.input_queue.task_done()
+                    self.attempts.pop(record['filename'], None)
+                else:
+                    received_headers[record['filename']] = record['dataset']
+                    self.input_queue.release()
+                    retry = True
+
+            if retry:
+                logger.error(f"{len(batch) - len(stored)} instances couldn't be written to the database. "
+                             f"Retrying in {delay} seconds.")
+                self.stop_event.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            else:
+                delay = self.retry_delay
+
+    def failed(self, filename: str) -> int:
+
+        """ Counts a failed attempt to write an instance, and returns its failed attempts. """
+
+        self.attempts[filename] = self.attempts.get(filename, 0) + 1
+        return self.attempts[filename]
+
+    def load_record(self, item: dict):
+
+        """
+
+            Builds the record of a queued instance for db_store_batch, with the header parsed by
+            the C-STORE handler (or read again from the stored file after a restart) and the
+            element for the Compilator. Returns None if the file can't be read.
+
+        """
+
+        filename = item['filename']
+        try:
+            dataset = received_headers.pop(filename, None)
+            if dataset is None:
+                dataset = read_header(filename)
+            cached = instance_metadata.get(dataset.SOPInstanceUID)
+            if cached is None:
+                cached = extract_from_dataset(dataset)
+                instance_metadata.put(dataset.SOPInstanceUID, *cached)
+        except:
+            logger.error(f"{filename} can't be read. Discarding it.")
+            logger.error(traceback.format_exc())
+            return None
+
+        new_ds, recon_ds = cached
+        element = {'dataset': new_ds, 'recon_ds': recon_ds,
+                   'address': item['address'], 'ae_title': item['ae_title']}
+        return {'dataset': dataset, 'filename': filename, 'element': element}
+
+    def collect_batch(self):
+
+        """
+
+            Waits for an element in the input queue and returns it, along with the elements received
+            during the following 'window' seconds (up to max_batch elements).
+
+        """
+
+        try:
+            batch = [self.input_queue.get(timeout = 1)]
+        except Empty:
+            return []
+
+        deadline = monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.input_queue.get(timeout = remaining))
+            except Empty:
+                break
+
+        return batch
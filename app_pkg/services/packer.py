@@ -1,28 +1,61 @@
 import threading, logging, os, json, traceback
-from shutil import make_archive, rmtree
-from simple_file_checksum import get_checksum
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+from time import localtime
 from pydicom import dcmread
 import numpy as np
+import zstandard
 
 from app_pkg import application, db
 from app_pkg.db_models import Task, AppConfig
+from app_pkg.services.stage import StageRuntime
 
 # Configure logging
 logger = logging.getLogger('__main__')
 
-class SeriesPacker():
+# zstd level used for the 'int_zstd' payload format
+ZSTD_LEVEL = 1
 
-    def __init__(self, input_queue, next_step = 'uploader'):
+class HashingWriter():
+
+    """
+
+        Write-only file object that computes the SHA-256 of the bytes written to it
+        and passes them on to another file object.
+
+    """
+
+    def __init__(self, fileobj):
+
+        self.fileobj = fileobj
+        self.hash = sha256()
+
+    def write(self, data):
+
+        self.hash.update(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+
+        return self.hash.hexdigest()
+
+class SeriesPacker(StageRuntime):
+
+    def __init__(self, input_queue, next_step = 'uploader', decoding_threads = None):
 
         self.input_queue = input_queue
         self.next_step = next_step
+        # Threads used to decode the slices of each series (None uses the executor default)
+        self.decoding_threads = decoding_threads
 
     def start(self):
 
         """
         
-            Starts the process thread.            
+            Starts the worker threads (config.packer_workers of them). Each worker writes
+            its task archive directly to a partial file in zip_dir (renamed when complete),
+            so several tasks can be packed at once.
 
         """
 
@@ -44,12 +77,14 @@ class SeriesPacker():
         except:
             logger.error(f'destination {config.zip_dir} directory could not be created')
             return "Packer can't be started: storage access error"
-                
+
         if not self.get_status() == 'Corriendo':
-            # Create and start the thread if all conditions are fullfilled
-            self.main_thread = threading.Thread(target = self.main, args = ())        
-            self.main_thread.start()
-            logger.info('SeriesPacker started')
+            # Remove partial archives left by interrupted tasks
+            for name in os.listdir(config.zip_dir):
+                if name.endswith('.part'):
+                    os.remove(os.path.join(config.zip_dir, name))
+            # Create and start the threads if all conditions are fullfilled
+            self.start_workers(config.packer_workers, 'SeriesPacker')
             return "Packer inició exitosamente"
         else:
             return "Packer ya está corriendo"
@@ -58,47 +93,18 @@ class SeriesPacker():
 
         """
         
-            Stops the thread by setting an Event.
+            Stops the threads by setting an Event.
 
         """
         try:
             self.stop_event.set()
-            self.main_thread.join()
+            self.join_workers()
             logger.info("SeriesPacker stopped")
             return "Packer detenido"
         except Exception as e:
             logger.error("SeriesPacker stop failed")
             logger.error(traceback.format_exc())
             return "Packer no pudo ser detenido"
-    
-    def get_status(self):
-
-        try:
-            assert self.main_thread.is_alive()            
-        except AttributeError:
-            return 'No iniciado'
-        except AssertionError:
-            return 'Detenido'
-        except:
-            return 'Desconocido'
-        else:
-            return 'Corriendo'
-
-    def main(self):
-
-        while not self.stop_event.is_set() or not self.input_queue.empty():            
-                            
-                if not self.input_queue.empty():
-                    task_id = self.input_queue.get()
-                    with application.app_context():
-                        reprocess = self.task_step_handler(task_id)
-                    while reprocess and not self.stop_event.is_set():
-                        logger.info(f'reprocessing {task_id}')   
-                        with application.app_context():                     
-                            reprocess = self.task_step_handler(task_id)
-                        sleep(5)
-                else:
-                    sleep(1)
 
     def task_step_handler(self, task_id):
                             
@@ -117,44 +123,53 @@ class SeriesPacker():
             # Get filenames for the instances of this task
             filenames = [i.filename for i in task.instances]
 
-            # Extract voxel values
-            voxels = self.extract_voxels(filenames)           
+            # The archive is written under a temporary name and renamed when complete
+            zip_fname = task_id + '_' + config.client_id + '.zip'
+            archive_name = os.path.join(config.zip_dir, zip_fname)
+            partial_name = archive_name + '.part'
+            logger.info('packing files to ' + archive_name)
 
-            # Save voxel values to disk
-            os.makedirs('temp_series_packer', exist_ok = True)
-            np.save(os.path.join('temp_series_packer', 'voxels'), voxels)
+            # Image data is streamed into the archive in the configured payload format,
+            # hashing it on the way (the SHA-256 is always that of the uncompressed .npy):
+            #   · float32: voxel values as float32 in voxels.npy
+            #   · int_zstd: stored pixel values in voxels.npy.zst (zstd compressed) and
+            #     per-slice slope and intercept in rescale.npy
+            payload_format = config.payload_format or 'float32'
+            with ZipFile(partial_name, 'w') as archive:
+                if payload_format == 'int_zstd':
+                    pixels, rescale = self.extract_pixels(filenames)
+                    with self.open_member(archive, 'rescale.npy', ZIP_DEFLATED) as member:
+                        np.lib.format.write_array(member, rescale)
+                    cctx = zstandard.ZstdCompressor(level = ZSTD_LEVEL, threads = -1)
+                    with self.open_member(archive, 'voxels.npy.zst', ZIP_STORED) as member:
+                        with cctx.stream_writer(member, closefd = False) as compressor:
+                            writer = HashingWriter(compressor)
+                            np.lib.format.write_array(writer, pixels)
+                else:
+                    voxels = self.extract_voxels(filenames)
+                    with self.open_member(archive, 'voxels.npy', ZIP_DEFLATED) as member:
+                        writer = HashingWriter(member)
+                        np.lib.format.write_array(writer, voxels)
                                 
-            # Save neccesary metadata
-            metadata = {
-                'client_id': config.client_id,
-                'task_id': task_id,
-                'recon_settings': json.loads(task.recon_settings),
-                'PatientWeight': task.task_series.study.PatientWeight,
-                'PatientSize': task.task_series.study.PatientSize,
-                'PatientAge': task.task_series.study.PatientAge,
-                'StudyInstanceUID': task.task_series.study.StudyInstanceUID,
-                'SeriesInstanceUID': task.series,
-                'SeriesNumber': task.task_series.SeriesNumber,
-                'SeriesDate': task.task_series.SeriesDate.strftime('%Y-%m-%d'),
-                'SeriesTime': task.task_series.SeriesDate.strftime('%H:%M:%S'),
-                'sha256':get_checksum(os.path.join('temp_series_packer', 'voxels.npy'), algorithm="SHA256")
-            }
-            with open(os.path.join("temp_series_packer", "metadata.json"), "w") as jsonfile:  
-                json.dump(metadata, jsonfile, indent = 2)     
-
-            # Zip voxels and metadata in a file with the task id and client id as name
-            zip_fname = task_id + '_' + config.client_id
-            archive_name = os.path.join(config.zip_dir, zip_fname)           
-            logger.info('zipping files to ' + archive_name)         
-            make_archive(archive_name, 'zip', "temp_series_packer")
-            
-            # Delete temporary folder
-            try:
-                logger.info('removing temp folder')
-                rmtree('temp_series_packer')
-            except Exception as e:
-                logger.info('could not remove temporary folder')
-                logger.info(traceback.format_exc())
+                # Save neccesary metadata
+                metadata = {
+                    'client_id': config.client_id,
+                    'task_id': task_id,
+                    'recon_settings': json.loads(task.recon_settings),
+                    'PatientWeight': task.task_series.study.PatientWeight,
+                    'PatientSize': task.task_series.study.PatientSize,
+                    'PatientAge': task.task_series.study.PatientAge,
+                    'StudyInstanceUID': task.task_series.study.StudyInstanceUID,
+                    'SeriesInstanceUID': task.series,
+                    'SeriesNumber': task.task_series.SeriesNumber,
+                    'SeriesDate': task.task_series.SeriesDate.strftime('%Y-%m-%d'),
+                    'SeriesTime': task.task_series.SeriesDate.strftime('%H:%M:%S'),
+                    'payload_format': payload_format,
+                    'sha256': writer.hexdigest()
+                }
+                archive.writestr('metadata.json', json.dumps(metadata, indent = 2), compress_type = ZIP_DEFLATED)
+
+            os.replace(partial_name, archive_name)
             
             # Flag step as completed                                
             task.current_step = self.next_step
@@ -167,6 +182,10 @@ class SeriesPacker():
         except Exception as e:
             logger.info(f'compressing failed for task {task_id}')
             logger.error(traceback.format_exc())
+            try:
+                os.remove(partial_name)
+            except:
+                pass
             try:
                 task.status_msg = 'falló la compresión'
                 task.step_state = -1
@@ -179,22 +198,92 @@ class SeriesPacker():
                 logger.error(traceback.format_exc())   
                 return True
     
-    def extract_voxels(self, filenames):
+    def sort_slices(self, filenames):
+
+        """
+
+            Reads the slice positions and image format from the headers of a series.
+            Unreadable files are skipped.
 
-        datasets = []
+            Returns a list of (filename, header) tuples sorted along z.
+
+        """
+
+        headers = []
         for file in filenames:
             try:
-                datasets.append(dcmread(file))
+                headers.append((file, dcmread(file, stop_before_pixels = True,
+                                              specific_tags = ['ImagePositionPatient', 'Rows', 'Columns',
+                                                               'BitsAllocated', 'PixelRepresentation'])))
             except:
                 pass
             
-        # Sort by slice location
-        z = [ds.ImagePositionPatient[2] for ds in datasets]
-        order = np.argsort(z)
-        datasets = [datasets[idx] for idx in order]
+        headers.sort(key = lambda h: float(h[1].ImagePositionPatient[2]))
+        return headers
+
+    def extract_voxels(self, filenames):
+
+        """
+
+            Reads the voxel values of a series in floating point. Slices are decoded in parallel
+            and written straight into a preallocated volume, at their position sorted along z.
+
+            Returns an array with shape (columns, rows, slices).
+
+        """
+
+        headers = self.sort_slices(filenames)
+        rows, columns = headers[0][1].Rows, headers[0][1].Columns
+        volume = np.empty((len(headers), rows, columns), dtype = np.float32)
 
         # Extract voxel values in floating point
-        v = [ds.pixel_array.astype(np.float32) * ds.RescaleSlope + ds.RescaleIntercept for ds in datasets]
-        v = np.array(v).transpose([2,1,0])
+        def read_slice(idx, file):
+            ds = dcmread(file)
+            np.multiply(ds.pixel_array, np.float32(ds.RescaleSlope), out = volume[idx], dtype = np.float32)
+            volume[idx] += np.float32(ds.RescaleIntercept)
+
+        with ThreadPoolExecutor(max_workers = self.decoding_threads) as executor:
+            list(executor.map(read_slice, range(len(headers)), [h[0] for h in headers]))
         
-        return v
\ No newline at end of file
+        return volume.transpose([2,1,0])
+
+    def extract_pixels(self, filenames):
+
+        """
+
+            Reads the stored (integer) pixel values of a series and the rescale parameters of
+            each slice, so voxel values are pixels[:, :, k] * rescale[k, 0] + rescale[k, 1].
+
+            Returns the pixels array with shape (columns, rows, slices) and the rescale array
+            with shape (slices, 2).
+
+        """
+
+        headers = self.sort_slices(filenames)
+        first = headers[0][1]
+        dtype = np.dtype(('u' if first.PixelRepresentation == 0 else 'i') + str(first.BitsAllocated // 8))
+        pixels = np.empty((len(headers), first.Rows, first.Columns), dtype = dtype)
+        rescale = np.empty((len(headers), 2), dtype = np.float64)
+
+        def read_slice(idx, file):
+            ds = dcmread(file)
+            pixels[idx] = ds.pixel_array
+            rescale[idx] = ds.get('RescaleSlope', 1), ds.get('RescaleIntercept', 0)
+
+        with ThreadPoolExecutor(max_workers = self.decoding_threads) as executor:
+            list(executor.map(read_slice, range(len(headers)), [h[0] for h in headers]))
+
+        return pixels.transpose([2,1,0]), rescale
+
+    def open_member(self, archive, name, compression):
+
+        """
+
+            Opens a new member of a zip archive for writing, with the given compression.
+
+        """
+
+        zinfo = ZipInfo(name, date_time = localtime()[:6])
+        zinfo.compress_type = compression
+        zinfo.external_attr = 0o600 << 16
+        return archive.open(zinfo, 'w', force_zip64 = True)
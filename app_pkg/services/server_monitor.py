@@ -1,8 +1,9 @@
-import logging, threading, requests, traceback
+import logging, threading, traceback
 from time import sleep
 from datetime import datetime
 from app_pkg import application
 from app_pkg.db_models import AppConfig
+from app_pkg.functions.http_client import server_request
 
 
 # Configure logging
@@ -88,10 +89,9 @@ class ServerMonitor():
         with application.app_context():
             server_url = AppConfig.query.first().server_url
 
-        ping_url = 'http://' + server_url + '/' + self.ping_route
         start = datetime.now()
         try:
-            requests.get(ping_url, timeout = 5)
+            server_request('GET', server_url, self.ping_route)
             logger.debug(f'Connection succesful!')
             stop = datetime.now()
             etime = (stop - start).seconds
@@ -0,0 +1,105 @@
+import logging, threading
+from queue import Empty
+
+from app_pkg import application
+
+# Configure logging
+logger = logging.getLogger('__main__')
+
+class StageRuntime():
+
+    """
+
+        Input queue consumption shared by the pipeline stages that process Tasks.
+        Stages inherit from this class and provide:
+        - input_queue: the DurableQueue the task ids are read from (by priority).
+        - stop_event: a threading.Event set to stop the stage.
+        - task_step_handler(task_id): processes a task and returns True if it should be
+          processed again (e.g. the database was not available).
+
+        main() blocks on the input queue, so a task is handled as soon as it is put in it and
+        an idle stage doesn't wake up more than once every queue_timeout seconds (to check the
+        stop event). When the stage is stopped, the workers finish their current task and
+        the queued tasks are left in the queue for the next start.
+
+        A stage runs main() in a pool of worker threads (see start_workers), each of them
+        processing one task at a time, so task_step_handler must not share per-task state
+        between calls.
+
+    """
+
+    # Seconds to block on the input queue before checking the stop event
+    queue_timeout = 1
+    # Seconds to wait before processing again a task that asked for it
+    reprocess_delay = 5
+
+    def start_workers(self, workers, name):
+
+        """
+
+            Starts a pool of worker threads (at least one) consuming the input queue.
+
+        """
+
+        self.worker_threads = [threading.Thread(target = self.main, args = (), name = f'{name}-{n}')
+                               for n in range(max(workers or 1, 1))]
+        for thread in self.worker_threads:
+            thread.start()
+        logger.info(f'{name} started with {len(self.worker_threads)} workers')
+
+    def join_workers(self):
+
+        for thread in self.worker_threads:
+            thread.join()
+
+    def get_status(self):
+
+        try:
+            assert any(thread.is_alive() for thread in self.worker_threads)
+        except AttributeError:
+            return 'No iniciado'
+        except AssertionError:
+            return 'Detenido'
+        except:
+            return 'Desconocido'
+        else:
+            return 'Corriendo'
+
+    def main(self):
+
+        while not self.stop_event.is_set():
+
+            try:
+                task_id = self.input_queue.get(timeout = self.queue_timeout)
+            except Empty:
+                self.on_idle()
+            else:
+                self.process_task(task_id)
+
+    def process_task(self, task_id):
+
+        """
+
+            Runs task_step_handler for a task until it doesn't ask to be reprocessed or
+            the stage is stopped, and acknowledges it in the input queue (task_done).
+            A task still waiting to be reprocessed when the stage stops is released back to
+            the queue, keeping its place.
+
+        """
+
+        with application.app_context():
+            reprocess = self.task_step_handler(task_id)
+        while reprocess and not self.stop_event.wait(self.reprocess_delay):
+            logger.info(f'reprocessing {task_id}')
+            with application.app_context():
+                reprocess = self.task_step_handler(task_id)
+        if reprocess:
+            self.input_queue.release()
+        else:
+            self.input_queue.task_done()
+
+    def on_idle(self):
+
+        """ Called when no task arrived during queue_timeout seconds. """
+
+        pass
@@ -1,18 +1,115 @@
-from pynetdicom import AE
+from pynetdicom import AE, _config, build_context
 from pynetdicom.sop_class import PositronEmissionTomographyImageStorage
+from pydicom import dcmread
 from pydicom.dataset import Dataset
-import threading, logging, traceback
-from time import sleep
+from pydicom.dataelem import DataElement
+from pydicom.encaps import encapsulate
+from pydicom.encoders import RLELosslessEncoder
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, DeflatedExplicitVRLittleEndian, RLELossless
+from pydicom.filereader import read_file_meta_info
+import threading, logging, traceback, os
+from copy import deepcopy
+from queue import Queue
+from time import monotonic
 from typing import List, Union
 from pathlib import Path
 
 from app_pkg import application, db
 from app_pkg.db_models import Task, AppConfig
+from app_pkg.services.stage import StageRuntime
 
 # Configure logging
 logger = logging.getLogger('__main__')
 
-class StoreSCU(AE):    
+# Transfer syntaxes proposed (in order of preference) for each compression option of a Device,
+# besides the uncompressed ones
+TRANSFER_SYNTAXES = {
+    'uncompressed': [],
+    'deflate': [DeflatedExplicitVRLittleEndian],
+    'rle': [RLELossless],
+}
+# Uncompressed transfer syntaxes proposed to every device, each in its own presentation context
+# (deflate is only proposed to the devices that prefer it)
+UNCOMPRESSED_SYNTAXES = [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+PIXEL_DATA = 0x7FE00010
+
+class SharedDataset():
+
+    """
+
+        A dataset queued for all the device senders (see StoreSCU.send_to_devices).
+        For a file, only its file meta information is read in advance: the dataset is decoded
+        the first time a sender needs it, and the decoded dataset is shared by all the senders.
+
+        pydicom changes the encoding properties of a dataset (and its sequence items) to the
+        ones it is encoded with, so the senders must hold lock while they use the decoded dataset.
+
+    """
+
+    def __init__(self, path: str = None, file_meta: Dataset = None, dataset: Dataset = None):
+
+        self.path = path
+        self.file_meta = file_meta
+        self._dataset = dataset
+        self._original = None
+        self._encodings = {}
+        self.lock = threading.Lock()
+
+    def decode(self, transfer_syntax: str = None) -> Dataset:
+
+        """
+
+            Returns the decoded dataset (reading it only once), ready to be sent with a compressed
+            transfer_syntax, or with the encoding it had before being sent to other devices if
+            transfer_syntax is None. Call it holding lock.
+
+        """
+
+        if self._dataset is None:
+            self._dataset = dcmread(self.path)
+        if self._original is None:
+            dataset = self._dataset
+            pixel_data = dataset[PIXEL_DATA] if PIXEL_DATA in dataset else None
+            self._original = (dataset.get('file_meta'), pixel_data, dataset.is_implicit_VR, dataset.is_little_endian)
+        self.apply(*self._original)
+        if transfer_syntax is not None:
+            if transfer_syntax not in self._encodings:
+                self._encodings[transfer_syntax] = self.encode(transfer_syntax)
+            # Compressed transfer syntaxes are explicit VR little endian
+            self.apply(*self._encodings[transfer_syntax], False, True)
+        return self._dataset
+
+    def apply(self, file_meta: Dataset, pixel_data: DataElement, is_implicit_VR: bool, is_little_endian: bool):
+
+        """ Sets the elements and encoding properties that change between transfer syntaxes. """
+
+        if file_meta is not None:
+            self._dataset.file_meta = file_meta
+        if pixel_data is not None:
+            self._dataset[PIXEL_DATA] = pixel_data
+        self._dataset.is_implicit_VR = is_implicit_VR
+        self._dataset.is_little_endian = is_little_endian
+
+    def encode(self, transfer_syntax: str) -> tuple:
+
+        """
+
+            Returns the file meta information and the pixel data element of the decoded dataset
+            for a compressed transfer syntax. They are the only elements that change, so the rest
+            of the dataset is shared by all the transfer syntaxes. Deflate is applied by pynetdicom
+            when encoding the dataset, RLE compresses the pixel data here.
+
+        """
+
+        file_meta = deepcopy(self._dataset.file_meta)
+        file_meta.TransferSyntaxUID = transfer_syntax
+        pixel_data = self._dataset[PIXEL_DATA]
+        if transfer_syntax == RLELossless:
+            frames = RLELosslessEncoder.iter_encode(self._dataset)
+            pixel_data = DataElement(PIXEL_DATA, 'OB', encapsulate(list(frames)), is_undefined_length=True)
+        return file_meta, pixel_data
+
+class StoreSCU(StageRuntime, AE):    
 
     """ The main class for creating and managing DICOM Store Service Class User.
         Inherits from pynetdicom AE class, so it has similar functionality.
@@ -35,16 +132,132 @@ class StoreSCU(AE):
     
     """
 
-    def __init__(self, input_queue, *args, **kwargs):
+    # Marks the end of the datasets put in the queue of a device sender
+    END = object()
+
+    def __init__(self, input_queue, *args, association_idle = 60, prefetch = 32, **kwargs):
 
         super().__init__(*args, **kwargs)
 
         # Set class properties
         self.input_queue = input_queue
+        # Seconds an association can be idle before it is released
+        self.association_idle = association_idle
+        # Datasets read in advance for each destination
+        self.prefetch = prefetch
+
+        # Idle established associations, reused between tasks: {association_key: [association, last used]}
+        self.associations = {}
+        self.associations_lock = threading.Lock()
 
         # Add requested contexts
         self.add_requested_context(PositronEmissionTomographyImageStorage)
 
+    def get_association(self, device: dict):
+
+        """
+
+            Takes the pooled association with a device out of the pool, or requests a new one
+            if there is no established association with it. It should be given back with
+            return_association when it is no longer used, so it is not shared between the
+            workers sending to the same device.
+
+        """
+
+        key = self.association_key(device)
+        with self.associations_lock:
+            association = self.associations.pop(key, [None])[0]
+        if association is None or not association.is_established:
+            association = self.associate(device['address'], device['port'], ae_title = device['ae_title'],
+                                         contexts = self.build_contexts(device))
+        return association
+
+    def return_association(self, device: dict, association):
+
+        """
+
+            Puts an association back in the pool, idle from now on. If another association with
+            the same device was pooled meanwhile, this one is released.
+
+        """
+
+        if not association.is_established:
+            return
+        key = self.association_key(device)
+        with self.associations_lock:
+            pooled = key in self.associations
+            if not pooled:
+                self.associations[key] = [association, monotonic()]
+        if pooled:
+            try:
+                association.release()
+            except:
+                logger.error(traceback.format_exc())
+
+    def association_key(self, device: dict) -> tuple:
+
+        return (device['ae_title'], device['address'], device['port'], device.get('transfer_syntax'))
+
+    def build_contexts(self, device: dict) -> list:
+
+        """
+
+            Builds the presentation contexts requested to a device: one for each transfer syntax
+            preferred by the device, and one for each uncompressed transfer syntax, so the peer
+            can accept the syntax the files are stored with and they are sent without converting them.
+
+        """
+
+        syntaxes = TRANSFER_SYNTAXES.get(device.get('transfer_syntax'), []) + UNCOMPRESSED_SYNTAXES
+        return [build_context(PositronEmissionTomographyImageStorage, ts) for ts in dict.fromkeys(syntaxes)]
+
+    def preferred_syntax(self, association, device: dict, sop_class: str):
+
+        """
+
+            Returns the first transfer syntax preferred by the device that was accepted for
+            sop_class, or None.
+
+        """
+
+        accepted = [cx.transfer_syntax[0] for cx in association.accepted_contexts if cx.abstract_syntax == sop_class]
+        for ts in TRANSFER_SYNTAXES.get(device.get('transfer_syntax'), []):
+            if ts in accepted:
+                return ts
+        return None
+
+    def release_associations(self, max_idle: float = 0):
+
+        """
+
+            Releases the pooled associations that have been idle for more than max_idle seconds.
+
+        """
+
+        with self.associations_lock:
+            idle = [key for key, (association, last_used) in self.associations.items()
+                    if monotonic() - last_used > max_idle or not association.is_established]
+            idle = [(key, self.associations.pop(key)[0]) for key in idle]
+        for key, association in idle:
+            try:
+                if association.is_established:
+                    association.release()
+                    logger.info(f"released idle association with {key[0]}@{key[1]}:{key[2]}")
+            except:
+                logger.error(traceback.format_exc())
+
+    def accepts_encoding(self, association, file_meta: Dataset) -> bool:
+
+        """
+
+            Checks if an association has an accepted context for the SOP class and the
+            transfer syntax of a file, so it can be sent without converting it.
+
+        """
+
+        return any(cx.abstract_syntax == file_meta.MediaStorageSOPClassUID and
+                   cx.transfer_syntax[0] == file_meta.TransferSyntaxUID for cx in association.accepted_contexts)
+
     def send_datasets(self, device: dict, datasets: List[Union[Dataset, str, Path]]) -> List[dict]:
         
         """
@@ -64,45 +277,107 @@ class StoreSCU(AE):
             Returns: a list with equal size as datasets. Each element is a boolean, indicating if store was succesful.
 
         """
-        # Create association
-        association = self.associate(device['address'], device['port'], ae_title = device['ae_title'])     
-        
-        # Send the C-STORE
-        results = []      
-        
+
+        return self.send_to_devices({'device': device}, datasets)['device']
+
+    def send_to_devices(self, devices: dict, datasets: List[Union[Dataset, str, Path]]) -> dict:
+
+        """
+
+            Sends a list of datasets to several devices at the same time. For each file only the
+            file meta information is read here, and it is passed to a sender thread for each device,
+            that sends it through the pooled association with that device. A file is decoded at most
+            once, by the first sender that has to convert it (see SharedDataset).
+
+            Args:
+                · devices: a dict with a device dict (see send_datasets) for each destination name.
+                · datasets: a list of pydicom.dataset.Dataset, str or pathlib.Path.
+
+            Returns: a dict with a list of booleans for each destination name (see send_datasets).
+
+        """
+
+        queues = {name: Queue(maxsize = self.prefetch) for name in devices}
+        results = {name: [] for name in devices}
+        senders = [threading.Thread(target = self.device_sender, args = (device, queues[name], results[name]),
+                                    name = f'StoreSCU-{name}')
+                   for name, device in devices.items()]
+        for sender in senders:
+            sender.start()
+
         for dataset in datasets:
+            if isinstance(dataset, Dataset):
+                dataset = SharedDataset(dataset = dataset)
+            else:
+                try:
+                    dataset = SharedDataset(os.fspath(dataset), read_file_meta_info(dataset))
+                except:
+                    logger.error(f"can't read {dataset}")
+                    logger.error(traceback.format_exc())
+                    dataset = None
+            for q in queues.values():
+                q.put(dataset)
+
+        for q in queues.values():
+            q.put(self.END)
+        for sender in senders:
+            sender.join()
+
+        return results
+
+    def device_sender(self, device: dict, datasets: Queue, results: list):
+
+        """
+
+            Sends the datasets put in the queue (until END is received) to a device and
+            appends the result of each C-STORE to results.
+            Files are compressed if the peer accepted a transfer syntax preferred by the device.
+            If not, they are streamed as they are encoded on disk when the peer accepted their
+            transfer syntax, so they are neither decoded nor encoded again, or else the shared
+            decoded dataset is converted by pynetdicom to an accepted transfer syntax.
+
+        """
+
+        association = None
+        unreachable = False
+        while (dataset := datasets.get()) is not self.END:
             try:
-                status = association.send_c_store(dataset)
-                if status and status.Status == 0:
-                    results.append(True)
+                assert dataset is not None and not unreachable
+                # Use the pooled association, or a new one if it was closed
+                if association is None or not association.is_established:
+                    association = self.get_association(device)
+                    if not association.is_established:
+                        unreachable = True
+                        logger.error(f"Association with {device['ae_title']}@{device['address']}:{device['port']} is not stablished")
+                        raise AssertionError
+                shared, dataset, transfer_syntax = dataset, None, None
+                if shared.path is not None:
+                    preferred = self.preferred_syntax(association, device, shared.file_meta.MediaStorageSOPClassUID)
+                    if preferred and preferred != shared.file_meta.TransferSyntaxUID:
+                        transfer_syntax = preferred
+                    elif self.accepts_encoding(association, shared.file_meta):
+                        dataset = shared.path
+                if dataset is not None:
+                    status = association.send_c_store(dataset)
                 else:
-                    results.append(False)
-            except RuntimeError:
+                    # The decoded dataset is shared by all the senders, so they encode it one at a time
+                    with shared.lock:
+                        status = association.send_c_store(shared.decode(transfer_syntax))
+                results.append(bool(status) and status.Status == 0)
+            except AssertionError:
                 results.append(False)
-                logger.error(f"Association with {device['ae_title']}@{device['address']}:{device['port']} is not stablished")     
             except Exception as e:
                 results.append(False)
                 logger.error(f"c-store failed")     
                 logger.error(traceback.format_exc())     
 
-        association.release()
-        return results
+        # Keep the association in the pool, idle from now on
+        if association is not None:
+            self.return_association(device, association)
     
-    def main(self):
-
-        while not self.stop_event.is_set() or not self.input_queue.empty():            
-                            
-                if not self.input_queue.empty():
-                    task_id = self.input_queue.get()
-                    with application.app_context():
-                        reprocess = self.task_step_handler(task_id)
-                    while reprocess and not self.stop_event.is_set():
-                        logger.info(f'reprocessing {task_id}')   
-                        with application.app_context():                     
-                            reprocess = self.task_step_handler(task_id)
-                        sleep(5)
-                else:
-                    sleep(1)
+    def on_idle(self):
+
+        self.release_associations(self.association_idle)
 
     def task_step_handler(self, task_id):
                 
@@ -117,11 +392,11 @@ class StoreSCU(AE):
             task.status_msg = 'enviando DICOMs'
             db.session.commit()
             
-            # Send datasets to each destination
-            dest = {d.name: {'ae_title':d.ae_title,'address':d.address,'port':d.port} for d in task.destinations}                  
+            # Send datasets to all destinations at the same time
+            dest = {d.name: {'ae_title':d.ae_title,'address':d.address,'port':d.port,
+                             'transfer_syntax':d.transfer_syntax or 'uncompressed'} for d in task.destinations}                  
             msg = []
-            for name, device in dest.items():
-                succesful = self.send_datasets(device, datasets)
+            for name, succesful in self.send_to_devices(dest, datasets).items():
                 msg.append(f"{name}: {sum(succesful)}/{len(datasets)}")
             logger.info(f'sending DICOMs task {task.id} ' + ' '.join(msg))
             status = '<br>'.join(msg)
@@ -151,20 +426,26 @@ class StoreSCU(AE):
 
         """
         
-            Starts the process thread.            
+            Starts the process thread.
+            Enables pynetdicom's STORE_SEND_CHUNKED_DATASET, so the files passed as paths are
+            sent as they are encoded on disk, without decoding them (see device_sender). It is a
+            process-wide pynetdicom setting, but it only changes how C-STORE requests are sent
+            from file paths, which no other AE of the application does.
 
         """
 
         with application.app_context():
-            self.ae_title  = AppConfig.query.first().store_scp_aet
+            config = AppConfig.query.first()
+            self.ae_title  = config.store_scp_aet
+
+        _config.STORE_SEND_CHUNKED_DATASET = True
     
         # Set an event to stop the thread later 
         self.stop_event = threading.Event()
 
         if not self.get_status() == 'Corriendo':
-            # Create and start the thread
-            self.main_thread = threading.Thread(target = self.main, args = ())        
-            self.main_thread.start()        
+            # Create and start the worker threads
+            self.start_workers(config.store_scu_workers, 'StoreSCU')
             logger.info(f'StoreSCU started with ae_title {self.ae_title}')
             return "Dicom send inició exitosamente"
         else:
@@ -179,7 +460,8 @@ class StoreSCU(AE):
         """
         try:
             self.stop_event.set()
-            self.main_thread.join()
+            self.join_workers()
+            self.release_associations()
             logger.info("StoreSCU stopped")
             return "StoreSCU detenido"
         except:
@@ -190,16 +472,3 @@ class StoreSCU(AE):
 
         self.stop()
         self.start()
-
-    def get_status(self):
-
-        try:
-            assert self.main_thread.is_alive()            
-        except AttributeError:
-            return 'No iniciado'
-        except AssertionError:
-            return 'Detenido'
-        except:
-            return 'Desconocido'
-        else:
-            return 'Corriendo'
\ No newline at end of file
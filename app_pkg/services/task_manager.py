@@ -1,8 +1,9 @@
 import threading, logging, os, traceback
-from time import sleep
+from queue import Empty
+from time import monotonic
 
 from app_pkg import application, db
-from app_pkg.db_models import Task
+from app_pkg.db_models import Task, completed_steps
 from app_pkg.functions.helper_funcs import process
 
 # Configure logging
@@ -14,16 +15,21 @@ class TaskManager():
     
         This thread finds the Tasks that are ready to initiate the next step
         and set them to continue.
+        Tasks are dispatched as soon as the step that completed them commits
+        (see completed_steps in db_models). The database is also swept every
+        sweep_period seconds to recover tasks whose notification was missed.
         Arguments:
         - queues: a dictionary with keys equal to the name of each step in
             the processing pipeline. Each value is the corresponding input_queue 
             for that process.
+        - sweep_period: seconds between database sweeps.
     
     """
 
-    def __init__(self, queues: dict):        
+    def __init__(self, queues: dict, sweep_period = 30):        
         
         self.input_queues = queues 
+        self.sweep_period = sweep_period
 
     def start(self):
 
@@ -80,33 +86,44 @@ class TaskManager():
 
         """
         
-        A loop that continuously searches for those Task with step_state = 1.
+        A loop that waits for completed steps and dispatches the Tasks to their next step.
+        Tasks with step_state = 1 are also searched in the database every sweep_period seconds.
 
         """
         
+        next_sweep = monotonic()
+
         while not self.stop_event.is_set():
+
+            try:
+                task_id = completed_steps.get(timeout = 1)
+            except Empty:
+                task_id = None
             
             with application.app_context():
-                # Find tasks with step_state = 1 (step completed) and
-                # put them in the next step input queue
-                try:
-                    tasks = Task.query.filter_by(step_state = 1)
-                except:
-                    logger.error(f"can't access database")
-                    logger.error(traceback.format_exc())
-                    continue
-
-                for task in tasks:
+                if task_id is not None:
+                    try:
+                        self.dispatch(Task.query.get(task_id))
+                    except:
+                        logger.error(f"can't access database")
+                        logger.error(traceback.format_exc())
+
+                # Find tasks with step_state = 1 (step completed) that were not dispatched
+                if monotonic() >= next_sweep:
+                    next_sweep = monotonic() + self.sweep_period
                     try:
-                        # Update task_status
-                        logger.info(f'passing task {task.id} to {task.current_step}')
-                        task.step_state = 0
-                        # Trigger next step by putting an element in its input queue
-                        self.input_queues[task.current_step].put(task.id)
-                        db.session.commit()
+                        tasks = Task.query.filter_by(step_state = 1).order_by(Task.priority.desc()).all()
                     except:
                         logger.error(f"can't access database")
                         logger.error(traceback.format_exc())
+                        continue
+
+                    for task in tasks:
+                        try:
+                            self.dispatch(task)
+                        except:
+                            logger.error(f"can't access database")
+                            logger.error(traceback.format_exc())
                 
                 # If server interaction is disabled, simulate processing
                 if not os.environ["SERVER_INTERACTION"] == "True":
@@ -124,6 +141,23 @@ class TaskManager():
                         except Exception as e:
                             logger.error(f"simulated processing failed")
                             logger.error(traceback.format_exc())
-                            
-            sleep(1)
-           
+
+    def dispatch(self, task):
+
+        """
+        
+            Puts a Task with step_state = 1 in the input queue of its current step, with
+            its priority.
+            Tasks that were already dispatched (or deleted) are ignored.
+
+        """
+
+        if task is None or task.step_state != 1:
+            return
+        
+        # Update task_status
+        logger.info(f'passing task {task.id} to {task.current_step}')
+        task.step_state = 0
+        db.session.commit()
+        # Trigger next step by putting an element in its input queue
+        self.input_queues[task.current_step].put(task.id, priority = task.priority or 0)
@@ -1,22 +1,25 @@
 import threading, logging, os, traceback
 from shutil import unpack_archive, rmtree
-from copy import deepcopy
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from pydicom import dcmread
+from pydicom import dcmread, Dataset, DataElement
+from pydicom.dataset import FileMetaDataset
+from pydicom.datadict import tag_for_keyword, dictionary_VR
+from pydicom.valuerep import DSfloat
 from pydicom.uid import generate_uid
 from datetime import datetime
-from app_pkg.functions.db_store_handler import store_dataset
-from app_pkg.functions.helper_funcs import filter_3D
+from app_pkg.functions.db_store_handler import db_store_series
+from app_pkg.functions.helper_funcs import rescale_slices, postfilter
 
 
 from app_pkg import application, db
-from app_pkg.db_models import AppConfig, Task, Series, FilterSettings, Radiopharmaceutical
+from app_pkg.db_models import AppConfig, Task, FilterSettings, Radiopharmaceutical
+from app_pkg.services.stage import StageRuntime
 
 # Configure logging
 logger = logging.getLogger('__main__')
 
-class SeriesUnpacker():
+class SeriesUnpacker(StageRuntime):
 
     def __init__(self, input_queue, next_step = 'store_scu'):
 
@@ -51,10 +54,8 @@ class SeriesUnpacker():
             return "Unpacker can't be started: storage access error"
          
         if not self.get_status() == 'Corriendo':
-            # Create and start the thread
-            self.main_thread = threading.Thread(target = self.main, args = ())        
-            self.main_thread.start()
-            logger.info('Unpacker started')
+            # Create and start the worker threads
+            self.start_workers(config.unpacker_workers, 'Unpacker')
             return "Unpacker inició exitosamente"
         else:
             return "Unpacker ya está corriendo"
@@ -69,7 +70,7 @@ class SeriesUnpacker():
         """
         try:
             self.stop_event.set()
-            self.main_thread.join()
+            self.join_workers()
             logger.info("SeriesUnpacker stopped")
             return "SeriesUnpacker detenido"            
         except Exception as e:
@@ -77,42 +78,12 @@ class SeriesUnpacker():
             logger.error(traceback.format_exc())
             return "SeriesUnpacker no pudo ser detenido"
 
-    def get_status(self):
-
-        try:
-            assert self.main_thread.is_alive()            
-        except AttributeError:
-            return 'No iniciado'
-        except AssertionError:
-            return 'Detenido'
-        except:
-            return 'Desconocido'
-        else:
-            return 'Corriendo'
-
-
-    def main(self):
-
-        while not self.stop_event.is_set() or not self.input_queue.empty():            
-                            
-                if not self.input_queue.empty():
-                    task_id = self.input_queue.get()
-                    with application.app_context():
-                        reprocess = self.task_step_handler(task_id)
-                    while reprocess and not self.stop_event.is_set():
-                        logger.info(f'reprocessing {task_id}')   
-                        with application.app_context():                     
-                            reprocess = self.task_step_handler(task_id)
-                        sleep(5)
-                else:
-                    sleep(1)
-
     def task_step_handler(self, task_id):
                 
         try:
             task = Task.query.get(task_id)
             config = AppConfig.query.first()
-            templates = [dcmread(i.filename) for i in task.instances]
+            templates = [dcmread(i.filename, stop_before_pixels = True) for i in task.instances]
         except:
             logger.error(f"task {task_id} status can't be updated")
             logger.error(traceback.format_exc())   
@@ -224,22 +195,18 @@ class SeriesUnpacker():
                 # Build dicom files
                 try:
                     series_uid, datasets = self.build_dicom_files(ss, templates)
-                    # Link this series as a result for this task
-                    s = Series(SeriesInstanceUID = series_uid, 
-                               patient = task.task_series.patient, 
-                               study = task.task_series.study,
-                               stored_in = os.path.join(task.task_series.study.stored_in,series_uid))
-                    db.session.add(s)
+                    # Store the series and its instances, and link it as a result for this task
+                    # in the same transaction
+                    s, stored = db_store_series(datasets, 'incoming', commit = False)
                     task.result_series.append(s)
                     db.session.commit()
-                    # Add datasets to the database 
-                    for ds in datasets:
-                        stored_ok += store_dataset(ds, 'incoming') == 0
+                    stored_ok += stored
                     success += 1
                     logger.info(f"Building dicoms for {extract_dir} successful")
                 except Exception as e:
                     logger.error(f"Failed when building dicoms for {extract_dir}")
                     logger.error(traceback.format_exc())
+                    db.session.rollback()
 
             logger.info(f"{stored_ok} dicoms stored succesfully")                        
             task.status_msg = f"creación dicoms {success}/{len(series)}" 
@@ -313,7 +280,9 @@ class SeriesUnpacker():
             assert recons
         except: 
             logger.info(f"No post-filter settings found; the processed with no post-filter will be sent.")
-            return [{'voxels': v,
+            pixels, slopes = rescale_slices(v)
+            return [{'pixels': pixels,
+                     'slopes': slopes,
                      'series_description':'PETFECTIOR',
                      'series_number':1001}]
         # Only apply filter settings valid for this pet model and radiopharmaceutical
@@ -325,13 +294,18 @@ class SeriesUnpacker():
             raise ValueError(f'No postfilter settings found for pet model {original_series.ManufacturerModelName}')
         series = []
 
+        # Each filter runs in its own thread, sharing the input volumes. The numpy operations,
+        # the Gaussian filter and the FFT release the GIL, so the filters run in parallel
+        workers = min(len(recons), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'PostFilter') as executor:
+            results = [executor.submit(postfilter, v, noise, r.noise/100, r.fwhm, voxel_size) for r in recons]
+
         series_description = original_series.SeriesDescription
-        for r in recons:
-            voxels = v + r.noise/100 * noise
-            voxels = np.abs(voxels)
-            voxels = filter_3D(voxels, r.fwhm, voxel_size)
+        for r, result in zip(recons, results):
+            pixels, slopes = result.result()
             series.append({
-                'voxels': voxels,
+                'pixels': pixels,
+                'slopes': slopes,
                 'series_description': series_description + '_' + r.description if r.mode=='append' else r.description,
                 'series_number':r.series_number
             })
@@ -339,41 +313,61 @@ class SeriesUnpacker():
 
     def build_dicom_files(self, input_dict, templates):
 
-        v = input_dict['voxels']
+        """
+
+            Builds the datasets of a result series from the headers of the original series
+            (read without pixel data). The elements of each template are shared by all the
+            datasets built from it, and are never modified: only the elements that change
+            (pixel data, rescale slope, UIDs, series number and description and times)
+            are created for each new dataset.
 
-        # Create new deep copy of templates
-        datasets = [deepcopy(ds) for ds in templates]
+        """
 
-        # Transpose to make for loops easier
-        v = np.array(v).transpose([2,1,0])
-        # Calculate rescale slopes for each slice
-        slopes = (v.max(axis = (1,2)) / (2**15 - 1)).reshape((v.shape[0],1,1))        
-        # Normalize each slice to 2**16 - 1 as max value and convert to uint16
-        v = (v / slopes).astype(np.uint16)          
+        # uint16 slices, with shape (slices, rows, columns), and their rescale slopes
+        v = input_dict['pixels']
+        slopes = input_dict['slopes']
             
         # Sort by slice location
-        z = [ds.ImagePositionPatient[2] for ds in datasets]
-        order = np.argsort(z)
-        datasets = [datasets[idx] for idx in order]
-        
-        # Replace voxel values on templates
-        for idx, ds in enumerate(datasets):
-            ds.PixelData = v[idx].tobytes()
-            ds.RescaleSlope = slopes[idx]
+        templates = sorted(templates, key = lambda ds: ds.ImagePositionPatient[2])
 
-        # Use .npy file as SeriesDescription
         series_uid = generate_uid()
         timenow = datetime.now().strftime('%H%M%S')
-        for ds in datasets:            
-            ds.InstanceCreationTime = timenow
-            ds.SOPInstanceUID = generate_uid()
-            ds.ContentTime = timenow
-            ds.SeriesInstanceUID = series_uid
-            ds.SeriesNumber = input_dict['series_number']
-            ds.SeriesDescription = input_dict['series_description']
+        datasets = []
+        for idx, template in enumerate(templates):
+            ds = Dataset()
+            ds.update(template)
+            ds.is_little_endian = template.is_little_endian
+            ds.is_implicit_VR = template.is_implicit_VR
+
+            # Replace voxel values and identifiers with new elements
+            sop_uid = generate_uid()
+            self.set_element(ds, template, 'PixelData', v[idx].tobytes())
+            self.set_element(ds, template, 'RescaleSlope', DSfloat(float(slopes[idx]), auto_format = True))
+            self.set_element(ds, template, 'InstanceCreationTime', timenow)
+            self.set_element(ds, template, 'SOPInstanceUID', sop_uid)
+            self.set_element(ds, template, 'ContentTime', timenow)
+            self.set_element(ds, template, 'SeriesInstanceUID', series_uid)
+            self.set_element(ds, template, 'SeriesNumber', input_dict['series_number'])
+            self.set_element(ds, template, 'SeriesDescription', input_dict['series_description'])
+
+            ds.file_meta = FileMetaDataset()
+            ds.file_meta.update(template.file_meta)
+            self.set_element(ds.file_meta, template.file_meta, 'MediaStorageSOPInstanceUID', sop_uid)
+            datasets.append(ds)
 
         return [series_uid, datasets]
 
+    def set_element(self, ds, template, keyword, value):
+
+        """
 
+            Sets a new element in ds (keeping the VR it has in the template), instead of changing
+            the value of the element shared with the template.
 
+        """
 
+        tag = tag_for_keyword(keyword)
+        vr = template[tag].VR if tag in template else dictionary_VR(tag)
+        if keyword == 'PixelData' and tag not in template:
+            vr = 'OW'
+        ds[tag] = DataElement(tag, vr, value)
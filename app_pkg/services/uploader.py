@@ -1,20 +1,25 @@
-import logging, threading, os, requests, traceback, re
+import logging, threading, os, traceback, re, json
+from zipfile import ZipFile
 from time import sleep
-from shutil import copy
+from hashlib import sha256
 from pydicom.dataset import Dataset
 from datetime import datetime
 
 from app_pkg import application, db
 from app_pkg.db_models import Task, AppConfig
+from app_pkg.services.stage import StageRuntime
+from app_pkg.functions.http_client import server_request
 
 # Configure logging
 logger = logging.getLogger('__main__')
 
-class SeriesUploader():
+class SeriesUploader(StageRuntime):
 
-    def __init__(self, input_queue):
+    def __init__(self, input_queue, chunk_size = 8 * 1024 * 1024, max_retries = 5):
 
         self.input_queue = input_queue
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
 
     def start(self):
 
@@ -43,10 +48,8 @@ class SeriesUploader():
             os.makedirs(os.path.join(config.shared_mount_point, 'to_process'), exist_ok = True)
 
             if not self.get_status() == 'Corriendo':
-                # Start the thread
-                self.main_thread = threading.Thread(target = self.main, args = ())        
-                self.main_thread.start()
-                logger.info('Uploader started')
+                # Start the worker threads
+                self.start_workers(config.uploader_workers, 'Uploader')
                 return "Uploader inició exitosamente"
             else:
                 return "Uploader ya está corriendo"
@@ -71,7 +74,7 @@ class SeriesUploader():
             # Event to interrupt processing        
             self.stop_event.set()
             # Stop the thread
-            self.main_thread.join()
+            self.join_workers()
             logger.info("Uploader stopped")
             return "Uploader detenido"
         except Exception as e:
@@ -79,35 +82,6 @@ class SeriesUploader():
             logger.error(traceback.format_exc())
             return "Uploader no pudo ser detenido"
 
-    def get_status(self):
-
-        try:
-            assert self.main_thread.is_alive()            
-        except AttributeError:
-            return 'No iniciado'
-        except AssertionError:
-            return 'Detenido'
-        except:
-            return 'Desconocido'
-        else:
-            return 'Corriendo'
-
-    def main(self):
-
-        while not self.stop_event.is_set() or not self.input_queue.empty():            
-                            
-                if not self.input_queue.empty():
-                    task_id = self.input_queue.get()
-                    with application.app_context():
-                        reprocess = self.task_step_handler(task_id)
-                    while reprocess and not self.stop_event.is_set():
-                        logger.info(f'reprocessing {task_id}')   
-                        with application.app_context():                     
-                            reprocess = self.task_step_handler(task_id)
-                        sleep(5)
-                else:
-                    sleep(1)
-
     def task_step_handler(self, task_id):
         
         try:                    
@@ -120,12 +94,14 @@ class SeriesUploader():
             task.status_msg = 'enviando'
             db.session.commit()
             basename = os.path.basename(filename)
-            copy(filename, os.path.join(config.shared_mount_point, 'to_process'))
+            with ZipFile(filename) as archive:
+                payload_format = json.loads(archive.read('metadata.json')).get('payload_format', 'float32')
+            checksum = self.upload_file(filename, os.path.join(config.shared_mount_point, 'to_process'))
              
             # Send a message to the server                   
             logger.info(f"copied {filename} to {os.path.join(config.shared_mount_point, 'to_process')} for task {task.id}")
 
-            assert self.send_message(basename, task, config)
+            assert self.send_message(basename, task, config, payload_format, checksum)
             logger.info('commit to server ok')
             logger.info(f"File {filename} deleted")
             task.status_msg = 'procesando'
@@ -148,7 +124,78 @@ class SeriesUploader():
 
             
 
-    def send_message(self, filename, task, config):
+    def upload_file(self, filename, destination_dir) -> str:
+
+        """
+
+            Copies a file to destination_dir in chunks, under a temporary name (.part) that is
+            renamed once the copy is complete, so the server never sees a partial file.
+            The file is hashed (SHA-256) while it is copied, so the copy is not read back.
+            If the copy is interrupted (e.g. the shared folder is unreachable), it is retried
+            up to max_retries times, resuming from the last complete chunk once the part
+            already copied is checked against the original (it is hashed once, on resume).
+
+            Returns the SHA-256 of the file (hex).
+
+        """
+
+        destination = os.path.join(destination_dir, os.path.basename(filename))
+        partial = destination + '.part'
+        size = os.path.getsize(filename)
+
+        attempt = 0
+        while True:
+            try:
+                # Resume from the last complete chunk of a previous attempt
+                offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+                offset = min(offset - offset % self.chunk_size, size)
+
+                with open(filename, 'rb') as src, open(partial, 'r+b' if offset else 'wb') as dst:
+                    source_hash = sha256()
+                    if offset:
+                        # Check the part kept from the previous attempt
+                        copy_hash = sha256()
+                        self.hash_prefix(src, source_hash, offset)
+                        self.hash_prefix(dst, copy_hash, offset)
+                        if source_hash.digest() == copy_hash.digest():
+                            logger.info(f"resuming upload of {filename} from byte {offset}")
+                        else:
+                            logger.error(f"partial upload of {filename} doesn't match the original. Copying it again.")
+                            offset = 0
+                            source_hash = sha256()
+                    src.seek(offset)
+                    dst.seek(offset)
+                    dst.truncate()
+                    while chunk := src.read(self.chunk_size):
+                        source_hash.update(chunk)
+                        dst.write(chunk)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+
+                # Verify the copy before making it visible to the server
+                if os.path.getsize(partial) != size:
+                    os.remove(partial)
+                    raise IOError(f"size mismatch in the uploaded copy of {filename}")
+                os.replace(partial, destination)
+                return source_hash.hexdigest()
+            except OSError:
+                attempt += 1
+                if attempt > self.max_retries or self.stop_event.is_set():
+                    raise
+                logger.error(f"upload of {filename} failed (attempt {attempt} of {self.max_retries})")
+                logger.error(traceback.format_exc())
+                sleep(min(2 ** attempt, 60))
+
+    def hash_prefix(self, file, file_hash, length: int):
+
+        """ Updates file_hash with the first length bytes of an open file. """
+
+        file.seek(0)
+        while length > 0 and (chunk := file.read(min(self.chunk_size, length))):
+            file_hash.update(chunk)
+            length -= len(chunk)
+
+    def send_message(self, filename, task, config, payload_format = 'float32', checksum = None):
         
         if not os.environ["SERVER_INTERACTION"] == "True":
             return True                        
@@ -158,10 +205,12 @@ class SeriesUploader():
             "input_file": filename,
             "client_port": os.environ["FLASK_RUN_PORT"],
             "client_id": config.client_id,
+            "payload_format": payload_format,
+            "sha256": checksum,
             "metadata": self.extract_metadata(task)
         }
         try:
-            post_rsp = requests.post('http://' + config.server_url + '/processing', json = data)
+            post_rsp = server_request('POST', config.server_url, 'processing', json = data)
             assert post_rsp.json()['response'] == 'Processing'
             logger.info(f"post to /processing on server succesful.")  
             return True
@@ -1,6 +1,5 @@
-import threading, logging, os, requests, json, traceback, re
-from requests import ConnectionError, JSONDecodeError
-from time import sleep
+import threading, logging, os, json, traceback, re
+from requests import ConnectionError, JSONDecodeError, Timeout
 from datetime import datetime
 from pydicom import Dataset
 
@@ -8,11 +7,13 @@ from typing import List
 
 from app_pkg import application, db
 from app_pkg.db_models import Device, Task, PetModel, AppConfig, Radiopharmaceutical
+from app_pkg.services.stage import StageRuntime
+from app_pkg.functions.http_client import server_request
 
 # Configure logging
 logger = logging.getLogger('__main__')
 
-class Validator():
+class Validator(StageRuntime):
 
     """
     
@@ -51,11 +52,8 @@ class Validator():
             # Set an event to stop the thread later 
             self.stop_event = threading.Event()
 
-            # Create and start the thread
-            self.main_thread = threading.Thread(target = self.main, 
-                                                args = (), name = 'Validator')        
-            self.main_thread.start()
-            logger.info('started')
+            # Create and start the worker threads
+            self.start_workers(config.validator_workers, 'Validator')
             return 'Validator inició exitosamente'
         else:
             return 'Validator ya está corriendo'
@@ -69,42 +67,13 @@ class Validator():
         """
         try:
             self.stop_event.set()
-            self.main_thread.join()
+            self.join_workers()
             logger.info("stopped")
             return "Validator detenido"
         except:
             logger.info("stopped")
             return "Validator no pudo ser detenido"
 
-    def main(self):
-
-        while not self.stop_event.is_set() or not self.input_queue.empty():            
-                            
-                if not self.input_queue.empty():
-                    task_id = self.input_queue.get()
-                    with application.app_context():
-                        reprocess = self.task_step_handler(task_id)
-                    while reprocess and not self.stop_event.is_set():
-                        logger.info(f'reprocessing {task_id}')   
-                        with application.app_context():                     
-                            reprocess = self.task_step_handler(task_id)
-                        sleep(5)
-                else:
-                    sleep(1)
-
-    def get_status(self):
-
-        try:
-            assert self.main_thread.is_alive()            
-        except AttributeError:
-            return 'No iniciado'
-        except AssertionError:
-            return 'Detenido'
-        except:
-            return 'Desconocido'
-        else:
-            return 'Corriendo'
-
     def task_step_handler(self, task_id):
         
         try:
@@ -206,7 +175,7 @@ class Validator():
                 logger.error(traceback.format_exc())   
                 return True
 
-        except ConnectionError as e:
+        except (ConnectionError, Timeout) as e:
             logger.info(f"server connection failed.")
             logger.info(traceback.format_exc())
             try:
@@ -576,7 +545,7 @@ class Validator():
         if not os.getenv("SERVER_INTERACTION") == "True":
             return True, "Interacción con el servidor deshabilitada (modo debug)"
         
-        post_rsp = requests.post('http://' + c.server_url + '/check_model', json = data)
+        post_rsp = server_request('POST', c.server_url, 'check_model', json = data)
 
         messages = {
             200: "La tarea ha sido validada por el servidor",
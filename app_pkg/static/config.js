@@ -57,7 +57,9 @@ $(document).ready(function () {
             { data: 'name', title:'Nombre' },
             { data: 'ae_title', title: 'AE Title' },
             { data: 'address', title: 'Dirección IP' },
-            { data: 'is_destination', title: 'Usar como destino', render: (data) => data ? 'Sí' : 'No' }
+            { data: 'is_destination', title: 'Usar como destino', render: (data) => data ? 'Sí' : 'No' },
+            { data: 'transfer_syntax', title: 'Compresión', render: (data) => ({'uncompressed': 'Ninguna', 'deflate': 'Deflate', 'rle': 'RLE'})[data] },
+            { data: 'priority', title: 'Prioridad' }
         ],
         searching: false,
         paging: false,
@@ -230,6 +232,8 @@ $(document).ready(function () {
             $('#deviceManagerIP').val(data.address.split(":")[0])
             $('#deviceManagerPort').val(data.address.split(":")[1])
             $( "#deviceManagerIsDest" ).prop( "checked", data.is_destination ) 
+            $('#deviceManagerTransferSyntax').val(data.transfer_syntax)
+            $('#deviceManagerPriority').val(data.priority)
 
             deviceAction = "edit"        
         }                
@@ -270,7 +274,9 @@ $(document).ready(function () {
             "ae_title":  $('#deviceManagerAET').val(),
             "address": $('#deviceManagerIP').val(),
             "port": $('#deviceManagerPort').val(),
-            "is_destination": $("#deviceManagerIsDest").prop("checked")
+            "is_destination": $("#deviceManagerIsDest").prop("checked"),
+            "transfer_syntax": $('#deviceManagerTransferSyntax').val(),
+            "priority": $('#deviceManagerPriority').val()
         }
         $.ajax({
             url: "/manage_remote_devices",
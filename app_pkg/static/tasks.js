@@ -14,9 +14,11 @@ $(document).ready(function () {
 
     var scrollTop = 0;
     var scrollingContainer;
-    var selectedRowId = null;
+    var selectedTaskId = null;
 
+    // Tasks are filtered, sorted and paginated by the server
     var tasks_table = $('#tasks').DataTable({
+        serverSide: true,
         ajax: "/get_tasks_table",
         columns: [
             { data: 'task_id', title: 'ID. Tarea', name: 'task_id'},
@@ -33,11 +35,12 @@ $(document).ready(function () {
                 }
             },            
             { data: 'source', title: 'Origen' },
-            { data: 'destinations', title: 'Destino' },
+            { data: 'destinations', title: 'Destino', orderable: false },
             { data: 'description', title: 'Series' },
             { data: 'imgs', title: 'Imgs' },
             { data: 'started', title: 'Comienzo' },
             { data: 'updated', title: 'Actualizado' },
+            { data: 'priority', title: 'Prioridad' },
         ],
         order: [[9, 'desc']],
         language: {
@@ -47,11 +50,14 @@ $(document).ready(function () {
             processing: " ",
         },
         processing: false,
-        paging: false,
+        paging: true,
+        pageLength: 50,
+        lengthMenu: [25, 50, 100, 250],
+        searchDelay: 500,
         scrollX: true,
         scrollY: calculateScrollY(),
-        searching: false,
-        info: false,
+        searching: true,
+        info: true,
         select: {
             style: 'single',
             selector: 'td',
@@ -65,10 +71,11 @@ $(document).ready(function () {
                 scrollTop = scrollingContainer.scrollTop();
             });
 
-            // Add click event for row selection
+            // Add click event for row selection (rows are redrawn on each refresh,
+            // so the selected task is kept by its id)
             $('#tasks tbody').on('click', 'tr', function () {                
-                var row = tasks_table.row(this);
-                selectedRowId = row.index()           
+                var data = tasks_table.row(this).data();
+                selectedTaskId = data ? data.task_id : null
             });
 
             // Add click event for showing error details
@@ -81,15 +88,15 @@ $(document).ready(function () {
         }
     });
 
-    // Auto refresh, keeping selected rows and scrolling position
+    // Auto refresh, keeping the current page, selected row and scrolling position
     function refreshTable() {
         tasks_table.ajax.reload(function () {
-            if (selectedRowId !== null) {
-                tasks_table.row(selectedRowId).select();
+            if (selectedTaskId !== null) {
+                tasks_table.row(function (idx, data) { return data.task_id === selectedTaskId; }).select();
             }
             scrollingContainer.scrollTop(scrollTop);
             setTimeout(refreshTable, 2000);
-        });
+        }, false);
     }
 
     // Add buttons functionality
@@ -110,7 +117,7 @@ $(document).ready(function () {
         action = $(this).attr('action')
         ajax_data["action"] = action
 
-        if (['delete', 'restart', 'retry_last_step'].includes(action)) {
+        if (['delete', 'restart', 'retry_last_step', 'bump_priority'].includes(action)) {
             ajax_data["task_id"] = tasks_table.row({ selected: true }).data().task_id
         }
         $.ajax({